@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+from constant import *
+from parser import TransportStreamChunks
+from parser import TransportPacketParser
+from parser import EpgCollector
+from parser import scan_tables
+
+
+class AsyncEpgStream:
+    # EPG of one live transport stream read from an asyncio.StreamReader;
+    # every stream keeps its own sections and events, so one event loop
+    # can follow several tuners at once
+    def __init__(self, reader, b_type, debug=False, max_packets=None, timeout=None,
+            chunk_size=READ_BUFFER_SIZE, verify=CACHE_VERIFY_CRC):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.collector = EpgCollector(b_type, debug, verify)
+        self.tsfile = TransportStreamChunks()
+        self.parser = TransportPacketParser(self.tsfile, SDT_PID + EIT_PID, debug,
+                self.collector.cache, self.collector.is_complete, max_packets, timeout)
+    def feed(self, data):
+        # finalized events of the services whose schedule this chunk completed
+        self.tsfile.feed(data)
+        parser = self.parser
+        t_packets = parser.read_tables(parser.read_sections(parser.read_packets()))
+        events = []
+        for t_packet in scan_tables(self.collector, parser, t_packets):
+            if t_packet.header.pid in EIT_PID:
+                events.extend(self.collector.finish_service(t_packet.eit.service_id))
+        return events
+    async def events(self):
+        # until the schedule is complete, a limit is reached or the stream ends
+        while not self.parser.done:
+            timeout = None
+            if self.parser.deadline != None:
+                timeout = max(self.parser.deadline - time.monotonic(), 0)
+            try:
+                data = await asyncio.wait_for(self.reader.read(self.chunk_size), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            for event in self.feed(data):
+                yield event
+        for event in self.collector.events():
+            yield event
+    def __aiter__(self):
+        return self.events()
+
+async def read_epg(reader, b_type, debug=False, max_packets=None, timeout=None):
+    # (service, events) as parse_ts returns them, events in the order they were finalized
+    stream = AsyncEpgStream(reader, b_type, debug, max_packets, timeout)
+    events = [event async for event in stream]
+    return (stream.collector.service_map, events)
+
+async def read_command(args, b_type, debug=False, max_packets=None, timeout=None):
+    # EPG of a recorder command writing the transport stream to its stdout,
+    # the command is killed once the schedule is complete
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE)
+    try:
+        return await read_epg(proc.stdout, b_type, debug, max_packets, timeout)
+    finally:
+        if proc.returncode == None:
+            proc.kill()
+        await proc.wait()
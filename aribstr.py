@@ -3,6 +3,7 @@
 
 import sys
 import array
+import functools
 from io import StringIO
 # import copy
 
@@ -93,9 +94,60 @@ ARIB_HIRAGANA_MAP.update(ARIB_BASE)
 # 、 22     、 22
 # ・ 26     ・ 26 
 
-ESC_SEQ_ASCII   = (0x1B, 0x28, 0x42)
 ESC_SEQ_ZENKAKU   = (0x1B, 0x24, 0x42)
-ESC_SEQ_HANKAKU = (0x1B, 0x28, 0x49)
+
+UNICODE_MAP = {}
+
+def jis_to_unicode(char, char2):
+    try:
+        return bytes(ESC_SEQ_ZENKAKU + (char, char2)).decode('iso-2022-jp')
+    except UnicodeDecodeError:
+        return None
+
+def get_unicode_map():
+    # ARIB code point -> unicode, built once per process
+    if UNICODE_MAP:
+        return UNICODE_MAP
+    kanji = {}
+    for char in range(0x21, 0x7F):
+        for char2 in range(0x21, 0x7F):
+            uni = jis_to_unicode(char, char2)
+            if uni != None:
+                kanji[(char << 8) + char2] = uni
+    for (wchar, gaiji) in GAIJI_MAP.items():
+        kanji.setdefault(wchar, gaiji)
+    alphanumeric = {}
+    hiragana = {}
+    katakana = {}
+    jis_x0201_katakana = {}
+    for char in range(0x21, 0x7F):
+        alphanumeric[char] = chr(char)
+        if char >= 0x77:
+            hiragana[char] = kanji.get((0x21 << 8) + ARIB_HIRAGANA_MAP[char])
+            katakana[char] = kanji.get((0x21 << 8) + ARIB_KATAKANA_MAP[char])
+        else:
+            hiragana[char] = kanji.get((0x24 << 8) + char)
+            katakana[char] = kanji.get((0x25 << 8) + char)
+        if char <= 0x5F:
+            jis_x0201_katakana[char] = chr(0xFF61 + char - 0x21)
+    UNICODE_MAP.update({
+            Code.KANJI:kanji,
+            Code.JIS_KANJI_PLANE_1:kanji,
+            Code.JIS_KANJI_PLANE_2:kanji,
+            Code.ALPHANUMERIC:alphanumeric,
+            Code.PROP_ALPHANUMERIC:alphanumeric,
+            Code.HIRAGANA:hiragana,
+            Code.PROP_HIRAGANA:hiragana,
+            Code.KATAKANA:katakana,
+            Code.PROP_KATAKANA:katakana,
+            Code.JIS_X0201_KATAKANA:jis_x0201_katakana,
+            Code.ADDITIONAL_SYMBOLS:GAIJI_MAP,
+            })
+    for table in UNICODE_MAP.values():
+        for (key, uni) in list(table.items()):
+            if uni == None:
+                del table[key]
+    return UNICODE_MAP
 
 
 class Buffer:
@@ -108,8 +160,6 @@ class CodeArea:
     LEFT = 'LEFT'
     RIGHT = 'RIGHT'
 
-class AribIndexError(Exception):
-    pass
 class EscapeSequenceError(Exception):
     pass
 class DegignationError(Exception):
@@ -148,132 +198,84 @@ class CodeSetController:
         elif CodeArea.RIGHT == area:
             self.graphic_right = buffer_index
         self.esc_seq_count = 0
-    def get_current_code(self, data):
-        if   data >= 0x21 and data <= 0x7E:
-            if self.single_shift:
-                code = self.v_buffer[self.single_shift]
-                self.single_shift = None
-                return code
-            else:
-                return self.v_buffer[self.graphic_left]
-        elif data >= 0xA1 and data <= 0xFE:
-            return self.v_buffer[self.graphic_right]
-        return None
     def set_escape(self, buffer_index, drcs):
         if buffer_index != None:
             self.esc_buffer_index = buffer_index
         self.esc_drcs = drcs
         self.esc_seq_count += 1
 
-class AribArray(array.array):
-    esc_seq = None
-    def pop0(self):
-        try:
-            return self.pop(0)
-        except IndexError:
-            raise AribIndexError
-    def append_str(self, esc_seq, *string):
-        if self.esc_seq != esc_seq:
-            self.extend(esc_seq)
-        self.esc_seq = esc_seq
-        if len(string) > 1:
-            self.extend(string)
-        else:
-            self.append(string[0])
-
 class AribString:
     def __init__(self, array):
         self.control = CodeSetController()
-        self.arib_array = AribArray('B', array)
-        self.jis_array = AribArray('B')
+        self.unicode_map = get_unicode_map()
+        self.arib_array = bytes(array)
+        self.pos = 0
         self.utf_buffer = StringIO()
         self.utf_buffer_symbol = StringIO()
         self.split_symbol = False
     def convert_utf_split(self):
         self.split_symbol = True
         self.convert()
-        self.flush_jis_array()
         return (self.utf_buffer.getvalue(), self.utf_buffer_symbol.getvalue())
     def convert_utf(self):
         self.convert()
-        self.flush_jis_array()
         return self.utf_buffer.getvalue()
-    def flush_jis_array(self):
-        if len(self.jis_array) > 0:
-            uni = 'UnicodeDecodeError'
-            try:
-                uni = self.jis_array.tobytes().decode('iso-2022-jp')
-            except UnicodeDecodeError:
-                pass
-            self.utf_buffer.write(uni)
-            self.jis_array = AribArray('B')
     def convert(self):
-        while True:
-            try:
-                data = self.arib_array.pop0()
-                if self.control.esc_seq_count:
-                    self.do_escape(data)
+        control = self.control
+        arib_array = self.arib_array
+        length = len(arib_array)
+        while self.pos < length:
+            data = arib_array[self.pos]
+            self.pos += 1
+            if control.esc_seq_count:
+                self.do_escape(data)
+            elif data >= 0x21 and data <= 0x7E:
+                # GL Table
+                if control.single_shift:
+                    code = control.v_buffer[control.single_shift]
+                    control.single_shift = None
                 else:
-                    if (data >= 0x21 and data <= 0x7E) or (data >= 0xA1 and data <= 0xFE):
-                        # GL/GR Table
-                        self.do_convert(data)
-                    elif data in (
-                            0x20,  # space
-                            0xA0,  # space (arib)
-                            0x09): # HT
-                        self.jis_array.append_str(ESC_SEQ_ASCII, 0x20)
-                    elif data in (
-                            0x0D,  # CR
-                            0x0A): # LF
-                        self.jis_array.append_str(ESC_SEQ_ASCII, 0x0A)
-                    else:
-                        # Control Character
-                        self.do_control(data)
-            except AribIndexError:
-                break
-        return self.jis_array
-    def do_convert(self, data):
-        (code, size) = self.control.get_current_code(data)
+                    code = control.v_buffer[control.graphic_left]
+                self.do_convert(code, data)
+            elif data >= 0xA1 and data <= 0xFE:
+                # GR Table
+                self.do_convert(control.v_buffer[control.graphic_right], data)
+            elif data in (
+                    0x20,  # space
+                    0xA0,  # space (arib)
+                    0x09): # HT
+                self.utf_buffer.write(' ')
+            elif data in (
+                    0x0D,  # CR
+                    0x0A): # LF
+                self.utf_buffer.write('\n')
+            else:
+                # Control Character
+                self.do_control(data)
+        return self.utf_buffer
+    def do_convert(self, code_set, data):
+        (code, size) = code_set
         char = data
-        char2 = 0x0
         if size == 2:
-            char2 = self.arib_array.pop0()
-        if char >= 0xA1 and char <= 0xFE:
+            if self.pos >= len(self.arib_array):
+                return
+            char2 = self.arib_array[self.pos]
+            self.pos += 1
+            if char >= 0xA1 and char <= 0xFE:
+                char2 = char2 & 0x7F
+            char = ((char & 0x7F) << 8) + char2
+        else:
             char = char & 0x7F
-            char2 = char2 & 0x7F
-        if code in (Code.KANJI, Code.JIS_KANJI_PLANE_1, Code.JIS_KANJI_PLANE_2):
-            # 漢字コード出力
-            self.jis_array.append_str(ESC_SEQ_ZENKAKU, char, char2)
-        elif code in (Code.ALPHANUMERIC, Code.PROP_ALPHANUMERIC):
-            # 英数字コード出力
-            self.jis_array.append_str(ESC_SEQ_ASCII, char)
-        elif code in (Code.HIRAGANA, Code.PROP_HIRAGANA):
-            # ひらがなコード出力
-            if char >= 0x77:
-                self.jis_array.append_str(ESC_SEQ_ZENKAKU, 0x21, ARIB_HIRAGANA_MAP[char])
-            else:
-                self.jis_array.append_str(ESC_SEQ_ZENKAKU, 0x24, char)
-        elif code in (Code.PROP_KATAKANA, Code.KATAKANA):
-            # カタカナコード出力
-            if char >= 0x77:
-                self.jis_array.append_str(ESC_SEQ_ZENKAKU, 0x21, ARIB_KATAKANA_MAP[char])
-            else:
-                self.jis_array.append_str(ESC_SEQ_ZENKAKU, 0x25, char)
-        elif code == Code.JIS_X0201_KATAKANA:
-            # 半角カタカナコード出力
-            self.jis_array.append_str(ESC_SEQ_HANKAKU, char)
-        elif code == Code.ADDITIONAL_SYMBOLS:
-            # 追加シンボル文字コード出力
-            self.flush_jis_array()
-            if self.split_symbol:
-                wchar = ((char << 8) + char2)
-                gaiji = GAIJI_MAP_TITLE.get(wchar)
-                if gaiji != None:
-                    self.utf_buffer_symbol.write(gaiji)
-                else:
-                    self.utf_buffer.write(GAIJI_MAP_OTHER.get(wchar, "??"))
-            else:
-                self.utf_buffer.write(GAIJI_MAP.get(((char << 8) + char2), "??"))
+        table = self.unicode_map.get(code)
+        if table == None:
+            # mosaic, DRCS and macro are not supported
+            return
+        if self.split_symbol and code in (Code.KANJI, Code.ADDITIONAL_SYMBOLS):
+            gaiji = GAIJI_MAP_TITLE.get(char)
+            if gaiji != None:
+                self.utf_buffer_symbol.write(gaiji)
+                return
+        self.utf_buffer.write(table.get(char, "??"))
     def do_control(self, data):
         if   data == 0x0F:
             self.control.invoke(Buffer.G0, CodeArea.LEFT, True)  # LS0
@@ -331,6 +333,38 @@ class AribString:
             self.control.degignate(data)
 
 
+ARIB_CACHE_SIZE = 16384
+
+def decode_utf(data):
+    return AribString(data).convert_utf()
+
+def decode_utf_split(data):
+    return AribString(data).convert_utf_split()
+
+class AribStringCache:
+    # LRU caches of converted strings keyed on the raw ARIB bytes
+    def __init__(self, maxsize=ARIB_CACHE_SIZE):
+        self.resize(maxsize)
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self.utf = functools.lru_cache(maxsize)(decode_utf)
+        self.utf_split = functools.lru_cache(maxsize)(decode_utf_split)
+    def clear(self):
+        self.utf.cache_clear()
+        self.utf_split.cache_clear()
+    def info(self):
+        return {
+                'utf':self.utf.cache_info()._asdict(),
+                'utf_split':self.utf_split.cache_info()._asdict()}
+
+ARIB_CACHE = AribStringCache()
+
+def arib_utf(data):
+    return ARIB_CACHE.utf(bytes(data))
+
+def arib_utf_split(data):
+    return ARIB_CACHE.utf_split(bytes(data))
+
 if __name__ == '__main__':
     f = open(sys.argv[1], 'rb')
     f.seek(0, 2)
@@ -341,8 +375,7 @@ if __name__ == '__main__':
     f.close()
 
     arib = AribString(arr)
-    arib.convert()
 
-    f = open("output.txt", 'wb')
-    arib.jis_array.tofile(f)
+    f = open("output.txt", 'w', encoding='utf-8')
+    f.write(arib.convert_utf())
     f.close()
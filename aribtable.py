@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import array
+try:
+    import zlib
+except ImportError:
+    zlib = None
 
 from constant import *
+from aribstr import arib_utf, arib_utf_split
 
 
 class Section:
+    __slots__ = ('length_total', 'length_current', 'length_prev', 'idx', 'data')
     def __init__(self, idx=5, length_prev=0):
         self.length_total = 0
         self.length_current = 0
@@ -14,6 +20,8 @@ class Section:
         self.data = array.array('B', (0xFF,0xFF,0xFF,0xFF,0xFF))
 
 class TransportPacketHeader:
+    __slots__ = ('pid', 'payload_unit_start_indicator',
+        'adaptation_field_control', 'pointer_field')
     def __init__(self, pid, payload_unit_start_indicator, adaptation_field_control, pointer_field):
         self.pid = pid
         self.payload_unit_start_indicator = payload_unit_start_indicator
@@ -21,6 +29,7 @@ class TransportPacketHeader:
         self.pointer_field = pointer_field
 
 class TransportPacket:
+    __slots__ = ('header', 'binary_data', 'sdt', 'eit')
     def __init__(self, header, packet):
         self.header = header
         self.binary_data = packet
@@ -38,6 +47,10 @@ class TransportPacket:
             self.header.adaptation_field_control, self.header.pointer_field)
 
 class ServiceDescriptionTable:
+    __slots__ = ('table_id', 'section_syntax_indicator', 'section_length',
+        'transport_stream_id', 'version_number', 'current_next_indicator',
+        'section_number', 'last_section_number', 'original_network_id',
+        'services')
     def __init__(self, packet):
         self.table_id = packet[5]                        # 8 uimsbf
         self.section_syntax_indicator = (packet[6] >> 7) # 1 bslbf
@@ -78,6 +91,9 @@ class ServiceDescriptionTable:
                         )
 
 class Service:
+    __slots__ = ('service_id', 'EIT_user_defined_flags', 'EIT_schedule_flag',
+        'EIT_present_following_flag', 'running_status', 'free_CA_mode',
+        'descriptors_loop_length', 'descriptors')
     def __init__(self, service_id, EIT_user_defined_flags, EIT_schedule_flag,
             EIT_present_following_flag, running_status, free_CA_mode,
             descriptors_loop_length):
@@ -108,6 +124,9 @@ class Service:
                         self.descriptors_loop_length)
 
 class ServiceDescriptor:
+    __slots__ = ('descriptor_tag', 'descriptor_length', 'service_type',
+        'service_provider_name_length', 'service_provider_name',
+        'service_name_length', 'service_name')
     def __init__(self, descriptor_tag, descriptor_length, service_type,
             service_provider_name_length, service_provider_name,
             service_name_length, service_name):
@@ -137,6 +156,10 @@ class ServiceDescriptor:
                         self.service_name)
 
 class EventInfomationTable:
+    __slots__ = ('table_id', 'section_length', 'service_id', 'version_number',
+        'current_next_indicator', 'section_number', 'last_section_number',
+        'transport_stream_id', 'original_network_id',
+        'segment_last_section_number', 'last_table_id', 'events')
     def __init__(self, packet):
         self.table_id                    = packet[5]                        # 8   uimsbf
         self.section_length              = (((packet[6] & 0x0F) << 8) + packet[7]) # 12
@@ -177,6 +200,10 @@ class EventInfomationTable:
             self.last_table_id)
 
 class Event:
+    __slots__ = ('transport_stream_id', 'service_id', 'event_id', 'start_time',
+        'duration', 'running_status', 'free_CA_mode',
+        'descriptors_loop_length', 'descriptors', 'desc_short', 'desc_content',
+        'desc_extend')
     def __init__(self, transport_stream_id, service_id, event_id, start_time, duration,
             running_status, free_CA_mode, descriptors_loop_length):
         self.transport_stream_id = transport_stream_id
@@ -208,6 +235,7 @@ class Event:
             self.descriptors_loop_length)
 
 class ContentDescriptor:
+    __slots__ = ('descriptor_tag', 'descriptor_length', 'content_type_array')
     def __init__(self, descriptor_tag, descriptor_length, content_type_array):
         self.descriptor_tag = descriptor_tag
         self.descriptor_length = descriptor_length
@@ -220,6 +248,8 @@ class ContentDescriptor:
                 self.descriptor_length)
 
 class ContentType:
+    __slots__ = ('content_nibble_level_1', 'content_nibble_level_2',
+        'user_nibble_1', 'user_nibble_2')
     def __init__(self, content_nibble_level_1, content_nibble_level_2,
             user_nibble_1, user_nibble_2):
         self.content_nibble_level_1 = content_nibble_level_1
@@ -238,6 +268,10 @@ class ContentType:
                 self.user_nibble_2)
 
 class ShortEventDescriptor:
+    # event_name/text are kept as raw ARIB bytes and decoded on first access
+    __slots__ = ('descriptor_tag', 'descriptor_length', 'ISO_639_language_code',
+        'event_name_length', 'event_name_data', 'text_length', 'text_data',
+        '_event_name', '_text')
     def __init__(self, descriptor_tag, descriptor_length,
             ISO_639_language_code, event_name_length,
             event_name, text_length, text):
@@ -245,9 +279,30 @@ class ShortEventDescriptor:
         self.descriptor_length = descriptor_length
         self.ISO_639_language_code = ISO_639_language_code
         self.event_name_length = event_name_length
-        self.event_name = event_name
+        self.event_name_data = event_name
         self.text_length = text_length
-        self.text = text
+        self.text_data = text
+        self._event_name = None
+        self._text = None
+    def decode(self):
+        (self._event_name, symbol) = arib_utf_split(self.event_name_data)
+        self._text = symbol + "\n" + arib_utf(self.text_data)
+    @property
+    def event_name(self):
+        if self._event_name == None:
+            self.decode()
+        return self._event_name
+    @event_name.setter
+    def event_name(self, value):
+        self._event_name = value
+    @property
+    def text(self):
+        if self._text == None:
+            self.decode()
+        return self._text
+    @text.setter
+    def text(self, value):
+        self._text = value
     def __str__(self):
         return (
         '   descriptor_tag=0x%02X\n'
@@ -266,6 +321,10 @@ class ShortEventDescriptor:
                 self.text)
 
 class ExtendedEventDescriptor:
+    # text is kept as raw ARIB bytes and decoded on first access
+    __slots__ = ('descriptor_tag', 'descriptor_length', 'descriptor_number',
+        'last_descriptor_number', 'ISO_639_language_code', 'length_of_items',
+        'items', 'text_length', 'text_data', '_text')
     def __init__(self, descriptor_tag, descriptor_length, descriptor_number,
             last_descriptor_number, ISO_639_language_code, length_of_items,
             items, text_length, text):
@@ -277,7 +336,13 @@ class ExtendedEventDescriptor:
         self.length_of_items = length_of_items
         self.items = items
         self.text_length = text_length
-        self.text = text
+        self.text_data = text
+        self._text = None
+    @property
+    def text(self):
+        if self._text == None:
+            self._text = arib_utf(self.text_data)
+        return self._text
     def __str__(self):
         return (
         '   descriptor_tag=%i\n'
@@ -296,6 +361,8 @@ class ExtendedEventDescriptor:
                 self.text)
 
 class Item:
+    __slots__ = ('item_description_length', 'item_description', 'item_length',
+        'item')
     def __init__(self, item_description_length, item_description,
             item_length, item):
         self.item_description_length = item_description_length
@@ -316,9 +383,23 @@ class Item:
 class CRC32MpegError(Exception):
     pass
 
-def crc32mpeg(data, table_id, section_length, crc=0xffffffff):
+def crc32mpeg_table(data, crc=0xffffffff):
     for d in data:
         idx = (((crc >> 24) ^ d) & 0xff)
         crc = ((CRC_32_MPEG[idx] ^ (crc << 8)) & 0xffffffff)
-    if (crc & 0xffffffff) != 0x0:
+    return crc
+
+def reverse32(value):
+    return int.from_bytes(value.to_bytes(4, 'little').translate(BIT_REVERSE), 'big')
+
+def crc32mpeg_zlib(data, crc=0xffffffff):
+    # CRC-32/MPEG-2 is the unreflected form of zlib's CRC-32. Feeding zlib
+    # bit-reversed bytes yields the bit-reversed MPEG-2 register.
+    data = bytes(data).translate(BIT_REVERSE)
+    return reverse32(zlib.crc32(data, reverse32(crc) ^ 0xffffffff) ^ 0xffffffff)
+
+crc32mpeg_calc = crc32mpeg_zlib if zlib else crc32mpeg_table
+
+def crc32mpeg(data, table_id, section_length, crc=0xffffffff):
+    if crc32mpeg_calc(data, crc) != 0x0:
         raise CRC32MpegError('table_id=0x%X section_length=%i' % (table_id, section_length))
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from constant import *
+from parser import TransportStreamFile
+from parser import MappedTransportStreamFile
+from parser import parse_ts
+from parser import parseEvents
+from parser import parseService
+from parser import TransportPacketParser
+from parser import EpgCollector
+from parser import scan_tables
+from aribstr import ARIB_CACHE
+
+
+BATCH_TYPE = {
+        'GR':TYPE_DIGITAL,
+        'BS':TYPE_BS,
+        'CS':TYPE_CS}
+
+class BatchError(Exception):
+    pass
+
+class BatchJob:
+    def __init__(self, input_file, channel_id, b_type, output_file=None):
+        self.input_file = input_file
+        self.channel_id = channel_id
+        self.b_type = b_type
+        self.output_file = output_file
+
+class BatchResult:
+    def __init__(self, job):
+        self.job = job
+        self.service = None
+        self.events = None
+        self.error = None
+        self.elapsed = 0.0
+        self.stats = {}
+
+def read_jobs(filename):
+    # INPUT_FILE CHANNEL_ID GR|BS|CS [OUTPUT_FILE], '-' for no channel id
+    jobs = []
+    f = open(filename, encoding='utf-8')
+    for (lineno, line) in enumerate(f, 1):
+        arr = line.split()
+        if not arr or arr[0].startswith('#'):
+            continue
+        if len(arr) not in (3, 4) or arr[2] not in BATCH_TYPE:
+            raise BatchError('%s:%i: invalid job: %s' % (filename, lineno, line.strip()))
+        channel_id = None if arr[1] == '-' else arr[1]
+        b_type = BATCH_TYPE[arr[2]]
+        if b_type == TYPE_DIGITAL and channel_id == None:
+            raise BatchError('%s:%i: channel id is required' % (filename, lineno))
+        output_file = arr[3] if len(arr) == 4 else None
+        jobs.append(BatchJob(arr[0], channel_id, b_type, output_file))
+    f.close()
+    return jobs
+
+def parse_job(job, debug=False, use_mmap=False, verify=CACHE_VERIFY_CRC):
+    result = BatchResult(job)
+    start = time.monotonic()
+    try:
+        if use_mmap:
+            tsfile = MappedTransportStreamFile(job.input_file, 'rb')
+        else:
+            tsfile = TransportStreamFile(job.input_file, 'rb')
+        try:
+            (result.service, result.events) = parse_ts(job.b_type, tsfile, debug,
+                    stats=result.stats, verify=verify)
+        finally:
+            tsfile.close()
+    except Exception as e:
+        result.error = '%s: %s' % (e.__class__.__name__, e)
+    result.elapsed = time.monotonic() - start
+    return result
+
+def get_pool_context():
+    # epgdump.py is a plain script, so workers are forked rather than spawned
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+# jobs started by the workers of the current pool, see start_job
+STARTED = None
+
+def init_worker(started):
+    global STARTED
+    STARTED = started
+
+def start_job(index, job, debug=False, use_mmap=False, verify=CACHE_VERIFY_CRC):
+    STARTED.put(index)
+    return parse_job(job, debug, use_mmap, verify)
+
+def print_result(result):
+    if result.error != None:
+        print("BATCH: %s: failed: %s" % (result.job.input_file, result.error), file=sys.stderr)
+    else:
+        print("BATCH: %s: %i services, %i events, %.2f sec" % (
+                result.job.input_file, len(result.service), len(result.events),
+                result.elapsed), file=sys.stderr)
+
+def run_pool(jobs, indices, results, workers, debug=False, use_mmap=False,
+        verify=CACHE_VERIFY_CRC):
+    # runs jobs[index] for indices into results; if a worker dies the pool
+    # breaks, then the jobs started but not finished are returned with the
+    # error and the jobs never started are left for the next pool
+    context = get_pool_context()
+    started = (context or multiprocessing).SimpleQueue()
+    error = None
+    with ProcessPoolExecutor(workers, context, init_worker, (started,)) as executor:
+        futures = [(index, executor.submit(start_job, index, jobs[index], debug, use_mmap,
+                verify))
+                for index in indices]
+        for (index, future) in futures:
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                error = '%s: %s' % (e.__class__.__name__, e)
+                continue
+            except Exception as e:
+                result = BatchResult(jobs[index])
+                result.error = '%s: %s' % (e.__class__.__name__, e)
+            results[index] = result
+            print_result(result)
+    running = set()
+    while error != None and not started.empty():
+        index = started.get()
+        if results[index] == None:
+            running.add(index)
+    started.close()
+    return (sorted(running), error)
+
+def run_batch(jobs, workers=None, debug=False, use_mmap=False, verify=CACHE_VERIFY_CRC):
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    while pending:
+        (running, error) = run_pool(jobs, pending, results, workers or os.cpu_count(),
+                debug, use_mmap, verify)
+        if error != None and not running:
+            # the pool broke before any job started, retrying would not help
+            running = [index for index in pending if results[index] == None]
+        # the jobs running when the pool broke are retried one by one,
+        # so only the one that kills its worker fails; a job alone in a pool
+        # that breaks fails even if it was not seen starting
+        for index in running:
+            (_, error) = run_pool(jobs, [index], results, 1, debug, use_mmap, verify)
+            if error != None and results[index] == None:
+                results[index] = BatchResult(jobs[index])
+                results[index].error = error
+                print_result(results[index])
+        pending = [index for index in pending if results[index] == None]
+    return results
+
+def reassembling(section_map):
+    # pid -> section started but not complete yet
+    pending = {}
+    for (pid, sect) in section_map.items():
+        if sect.length_total and sect.length_current < sect.length_total:
+            pending[pid] = sect
+    return pending
+
+def scan_chunk(filename, start, end, b_type, debug=False, use_mmap=False,
+        verify=CACHE_VERIFY_CRC, overlap=True, deadline=None):
+    # distinct SDT/EIT sections starting in [start, end), tables already parsed;
+    # without debug the chunk also ends once it holds a complete schedule, and
+    # without overlap a section crossing the end is left unfinished
+    timeout = None
+    if deadline != None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return (0, [], {})
+    if use_mmap:
+        tsfile = MappedTransportStreamFile(filename, 'rb')
+    else:
+        tsfile = TransportStreamFile(filename, 'rb')
+    tsfile.seek(start)
+    last = (end - start) // TS_PACKET_SIZE
+    # events are merged by the parent, here the collector only tracks completion
+    collector = EpgCollector(b_type, debug, verify)
+    collector.event_map = None
+    parser = TransportPacketParser(tsfile, SDT_PID + EIT_PID, debug, collector.cache,
+            collector.is_complete, last, timeout)
+    def read_chunk():
+        # the packets of the chunk, then only those finishing the sections crossing its end
+        yield from parser.read_packets()
+        if not overlap or parser.count < last or collector.is_complete():
+            return
+        crossing = reassembling(parser.section_map)
+        parser.done = False
+        parser.max_packets = last + CHUNK_OVERLAP_PACKETS
+        if not crossing:
+            return
+        for b_packet in parser.read_packets():
+            yield b_packet
+            # the packet has been reassembled by now
+            for (pid, sect) in list(crossing.items()):
+                if (parser.section_map.get(pid) is not sect or
+                        sect.length_current >= sect.length_total):
+                    del crossing[pid]
+            if not crossing:
+                return
+    t_packets = list(scan_tables(collector, parser,
+            parser.read_tables(parser.read_sections(read_chunk()))))
+    # a mapping is not read, the chunk went through the bytes up to its position
+    counters = {
+            'bytes_read':tsfile.tell() - start if use_mmap else tsfile.bytes_read,
+            'sync_losses':tsfile.sync_losses,
+            'packets_per_pid':parser.pid_count,
+            'sections_reassembled':parser.section_count,
+            'sections_dropped':parser.dropped,
+            'crc_errors':parser.crc_errors}
+    tsfile.close()
+    # the collector skips SDT once complete and EIT of services not in SDT yet
+    for t_packet in t_packets:
+        if t_packet.header.pid in SDT_PID:
+            if not t_packet.sdt.services:
+                parseService(t_packet, t_packet.binary_data)
+        elif not t_packet.eit.events:
+            parseEvents(t_packet, t_packet.binary_data)
+    # packets read past the end are counted by the chunk they belong to
+    return (min(parser.count, last), t_packets, counters)
+
+def parse_ts_parallel(b_type, filename, workers=None, debug=False, max_packets=None, use_mmap=False,
+        stats=None, verify=CACHE_VERIFY_CRC, timeout=None):
+    workers = workers or os.cpu_count()
+    size = os.path.getsize(filename)
+    if max_packets == None:
+        max_packets = 0 if debug else READ_PACKETS_MAX
+    if max_packets:
+        size = min(size, max_packets * TS_PACKET_SIZE)
+    chunk = max(-(-size // workers), TS_PACKET_SIZE)
+    chunk += -chunk % TS_PACKET_SIZE
+    collector = EpgCollector(b_type, debug, verify)
+    count = 0
+    totals = collections.Counter() # parser counters added up over the chunks
+    pid_count = collections.Counter()
+    deadline = time.monotonic() + timeout if timeout else None
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers, get_pool_context()) as executor:
+        # the last chunk ends at the packet limit like a serial scan does
+        futures = [executor.submit(scan_chunk, filename, start, min(start + chunk, size), b_type,
+                debug, use_mmap, verify, start + chunk < size, deadline)
+                for start in range(0, size, chunk)]
+        # chunks are merged in stream order, a section crossing a boundary is
+        # finished by the chunk it starts in; the chunks not needed once the
+        # schedule is complete or not started by the deadline are cancelled,
+        # running ones end on their own
+        merged = 0
+        for future in futures:
+            if collector.is_complete():
+                future.cancel()
+                continue
+            if deadline != None and time.monotonic() >= deadline and future.cancel():
+                continue
+            (chunk_count, t_packets, counters) = future.result()
+            count += chunk_count
+            pid_count.update(counters.pop('packets_per_pid', {}))
+            totals.update(counters)
+            merged += 1
+            for t_packet in t_packets:
+                if not collector.cache.lookup(t_packet.binary_data):
+                    collector.cache.add(t_packet.binary_data)
+                    collector.add(t_packet)
+                if collector.is_complete():
+                    break
+    print("SDT/EIT: %i packets read in %i chunks, %i duplicate sections skipped" % (
+            count, merged, collector.cache.count), file=sys.stderr)
+    scanned = time.perf_counter()
+    events = collector.events()
+    finished = time.perf_counter()
+    if stats != None:
+        # the keys of a serial scan, and the number of chunks merged
+        info = ARIB_CACHE.info()
+        stats.update({
+                'bytes_read':totals['bytes_read'],
+                'packets':count,
+                'chunks':merged,
+                'sync_losses':totals['sync_losses'],
+                'packets_per_pid':dict(('0x%04X' % pid, count)
+                    for (pid, count) in sorted(pid_count.items())),
+                'sections_reassembled':totals['sections_reassembled'],
+                'sections_dropped':totals['sections_dropped'],
+                'crc_errors':totals['crc_errors'],
+                'duplicate_sections':collector.cache.count,
+                'unchanged_sections':collector.unchanged,
+                'arib_strings_decoded':info['utf']['misses'] + info['utf_split']['misses'],
+                'arib_cache_hits':info['utf']['hits'] + info['utf_split']['hits'],
+                'scan_seconds':round(scanned - start, 6),
+                'decode_seconds':round(finished - scanned, 6)})
+    return (collector.service_map, events)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import getopt
+import tempfile
+
+from constant import *
+from aribtable import *
+from aribstr import arib_utf, ARIB_CACHE
+from parser import TransportStreamFile
+from parser import TransportPacketParser
+from parser import SectionCache
+from parser import parseService
+from parser import parseEvents
+from parser import add_service
+from parser import add_event
+from parser import sort_events
+from parser import parse_ts
+from xmltv import create_xml
+import tsgen
+
+STAGES = ('read', 'pid_filter', 'reassembly', 'crc', 'table', 'arib', 'merge', 'write')
+
+def bench_read(state):
+    tsfile = TransportStreamFile(state['filename'])
+    count = 0
+    for b_packet in tsfile:
+        count += 1
+    tsfile.close()
+    return count
+
+def bench_pid_filter(state):
+    tsfile = TransportStreamFile(state['filename'])
+    tsfile.set_pid_filter(SDT_PID + EIT_PID)
+    packets = [bytes(b_packet) for b_packet in tsfile]
+    tsfile.close()
+    state['packets'] = packets
+    return len(packets)
+
+def bench_reassembly(state):
+    # distinct sections, repeats dropped by the section cache as parse_ts does
+    tsfile = TransportStreamFile(state['filename'])
+    parser = TransportPacketParser(tsfile, SDT_PID + EIT_PID, True)
+    cache = SectionCache()
+    section_map = {}
+    sections = []
+    for b_packet in state['packets']:
+        header = parser.parse_header(b_packet)
+        if header.adaptation_field_control != 1:
+            continue
+        while True:
+            (next_packet, section) = parser.parse_section(header, section_map, b_packet)
+            if next_packet:
+                break
+            if section and not cache.lookup(section.data):
+                cache.add(section.data)
+                sections.append((header, section.data))
+    tsfile.close()
+    state['sections'] = sections
+    return len(sections)
+
+def bench_crc(state):
+    valid = []
+    for (header, data) in state['sections']:
+        section_length = ((data[6] & 0x0F) << 8) + data[7]
+        try:
+            crc32mpeg(data[5:section_length + 8], data[5], section_length)
+            valid.append((header, data))
+        except CRC32MpegError:
+            pass
+    state['sections'] = valid
+    return len(valid)
+
+def bench_table(state):
+    # TransportPacket checks the CRC again, see the crc stage for its share
+    t_packets = []
+    for (header, data) in state['sections']:
+        t_packet = TransportPacket(header, data)
+        if header.pid in SDT_PID:
+            parseService(t_packet, data)
+        else:
+            parseEvents(t_packet, data)
+        t_packets.append(t_packet)
+    state['t_packets'] = t_packets
+    return len(t_packets)
+
+def bench_arib(state):
+    ARIB_CACHE.clear()
+    count = 0
+    for t_packet in state['t_packets']:
+        if t_packet.header.pid in SDT_PID:
+            continue
+        for event in t_packet.eit.events:
+            for desc in event.descriptors:
+                if desc.descriptor_tag == TAG_SED:
+                    desc.decode()
+                    count += 2
+                elif desc.descriptor_tag == TAG_EED:
+                    for item in desc.items:
+                        arib_utf(item.item_description)
+                        arib_utf(item.item)
+                        count += 2
+    return count
+
+def bench_merge(state):
+    service_map = {}
+    event_map = {}
+    for t_packet in state['t_packets']:
+        if t_packet.header.pid in SDT_PID:
+            add_service(service_map, t_packet)
+    for t_packet in state['t_packets']:
+        if t_packet.header.pid in EIT_PID and t_packet.eit.service_id in service_map:
+            add_event(state['b_type'], event_map, t_packet)
+    state['service'] = service_map
+    state['events'] = sort_events(state['b_type'], event_map)
+    return len(state['events'])
+
+def bench_write(state):
+    create_xml(state['b_type'], None, state['service'], state['events'],
+            os.devnull, False, False)
+    return len(state['events'])
+
+def bench_end_to_end(state):
+    # the whole file through parse_ts and create_xml, as epgdump.py -d does
+    ARIB_CACHE.clear()
+    tsfile = TransportStreamFile(state['filename'])
+    (service, events) = parse_ts(state['b_type'], tsfile, True)
+    tsfile.close()
+    create_xml(state['b_type'], None, service, events, os.devnull, False, False)
+    return len(events)
+
+def run_stage(func, state):
+    start = time.perf_counter()
+    count = func(state)
+    return (time.perf_counter() - start, count)
+
+def bench_file(filename, b_type, repeat):
+    size = os.path.getsize(filename)
+    packets = size // TS_PACKET_SIZE
+    best = {}
+    for _ in range(repeat):
+        state = {'filename':filename, 'b_type':b_type}
+        for name in STAGES:
+            result = run_stage(globals()['bench_' + name], state)
+            if name not in best or result[0] < best[name][0]:
+                best[name] = result
+        result = run_stage(bench_end_to_end, state)
+        if 'end_to_end' not in best or result[0] < best['end_to_end'][0]:
+            best['end_to_end'] = result
+    stages = {}
+    for (name, (seconds, count)) in best.items():
+        stages[name] = {
+                'seconds':round(seconds, 6),
+                'items':count,
+                'packets_per_sec':round(packets / seconds) if seconds else None,
+                'mb_per_sec':round(size / 1e6 / seconds, 3) if seconds else None}
+    return {
+            'file':filename,
+            'b_type':b_type,
+            'bytes':size,
+            'packets':packets,
+            'repeat':repeat,
+            'stages':stages}
+
+def usage():
+    print('''USAGE: bench.py [-b|-s] [-r REPEAT] [-o OUTPUT_FILE] [INPUT_FILE ...]
+  -h, --help        print help message
+  -b, --bs          input files are BS channel
+  -s, --cs          input files are CS channel
+  -r, --repeat      run every stage this many times and keep the fastest
+  -o, --output      write json report to file instead of stdout
+Without input files a synthetic BS stream is generated with tsgen.
+''', file=sys.stderr)
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hbsr:o:', ['help', 'bs', 'cs',
+            'repeat=', 'output='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    b_type = TYPE_DIGITAL
+    repeat = 3
+    output_file = None
+    for o,a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o in ('-b', '--bs'):
+            b_type = TYPE_BS
+        elif o in ('-s', '--cs'):
+            b_type = TYPE_CS
+        elif o in ('-r', '--repeat'):
+            repeat = int(a)
+        elif o in ('-o', '--output'):
+            output_file = a
+    tmpdir = None
+    if not args:
+        tmpdir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmpdir.name, 'bench.ts')
+        tsgen.generate(filename, b_type=TYPE_BS, services=20, events=200, repeats=2)
+        args = [filename]
+        b_type = TYPE_BS
+    report = [bench_file(filename, b_type, repeat) for filename in args]
+    if tmpdir != None:
+        tmpdir.cleanup()
+    if output_file != None:
+        f = open(output_file, 'w')
+        json.dump(report, f, indent=2)
+        f.close()
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
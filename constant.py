@@ -2,6 +2,13 @@
 
 READ_PACKETS_MAX = 700000
 
+TS_PACKET_SIZE = 188
+READ_BUFFER_SIZE = TS_PACKET_SIZE * 16384 # 3 MiB
+# packets checked by one PID filter scan, also bounds a scan of a mapped file
+SCAN_PACKETS_MAX = READ_BUFFER_SIZE // TS_PACKET_SIZE
+# packets read past the end of a chunk at most, to finish sections crossing it
+CHUNK_OVERLAP_PACKETS = 65536
+
 TYPE_DIGITAL = ''
 TYPE_BS = 'BS_'
 TYPE_CS = 'CS_'
@@ -9,6 +16,23 @@ TYPE_CS = 'CS_'
 EIT_PID = (0x12, 0x26, 0x27)
 SDT_PID = (0x11,)
 
+SDT_TABLE_ID = (0x42, 0x46) # actual, other
+EIT_PF_TABLE_ID = (0x4E, 0x4F) # actual, other
+
+# how a repeated section is recognized by the section cache
+CACHE_VERIFY_NONE = 0  # same table/section/version
+CACHE_VERIFY_CRC = 1   # ... and same CRC_32 field
+CACHE_VERIFY_BYTES = 2 # ... and identical section bytes
+CACHE_VERIFY_NAMES = {'none': CACHE_VERIFY_NONE, 'crc': CACHE_VERIFY_CRC,
+        'bytes': CACHE_VERIFY_BYTES}
+
+# CRC32MpegError messages printed per parser before they are only counted
+CRC_ERROR_MESSAGES_MAX = 10
+
+# allocation sites reported by --trace-memory, and frames kept to find them
+TRACE_MEMORY_TOP = 10
+TRACE_MEMORY_FRAMES = 8
+
 TAG_SED = 0x4D # Short event descriptor
 TAG_EED = 0x4E # Extended event descriptor
 TAG_CD  = 0x54 # Content descriptor
@@ -167,6 +191,8 @@ CONTENT_TYPE = {
             }),
         }
 
+BIT_REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
 CRC_32_MPEG = (
     0x00000000, 0x04c11db7, 0x09823b6e, 0x0d4326d9,
     0x130476dc, 0x17c56b6b, 0x1a864db2, 0x1e475005,
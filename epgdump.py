@@ -1,35 +1,148 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import json
 import time
+import atexit
 import getopt
+import cProfile
+import tracemalloc
 
 from constant import *
 from parser import TransportStreamFile
+from parser import MappedTransportStreamFile
 from parser import parse_ts
+from parser import iter_epg
+from parser import EpgCollector
+from parser import find_events
 from xmltv import *
+from ndjson import create_ndjson
+from ndjson import create_merged_ndjson
+from batch import BatchError
+from batch import read_jobs
+from batch import run_batch
+from batch import parse_ts_parallel
+from epgstore import EpgStore
+from epgstore import parse_ts_store
 
 
 def usage():
     print('''USAGE: epgdump_py -c CHANNEL_ID -i INPUT_FILE -o OUTPUT_FILE
        epgdump_py -b -i INPUT_FILE -o OUTPUT_FILE
        epgdump_py -s -i INPUT_FILE -o OUTPUT_FILE
-       epgdump_py [-b|-s] -p TRANSPORT_STREAM_ID:SERVICE_ID:EVENT_ID -i INPUT_FILE
+       epgdump_py [-b|-s] -p TRANSPORT_STREAM_ID:SERVICE_ID:EVENT_ID[,...] -i INPUT_FILE
+       epgdump_py [-b|-s] -P ID_FILE -i INPUT_FILE
+       epgdump_py -B JOB_FILE [-j JOBS] [-o OUTPUT_FILE]
   -h, --help        print help message
   -b, --bs          input file is BS channel
   -s, --cs          input file is CS channel
+  -B, --batch       parse input files listed in job file
+                    (INPUT_FILE CHANNEL_ID|- GR|BS|CS [OUTPUT_FILE] per line)
   -c, --channel-id  specify channel identifier
   -d, --debug       parse all ts packet
   -f, --format      format xml
-  -i, --input       specify ts file
+  -J, --json        output newline-delimited json instead of xml
+                    ('-' as output file writes to stdout)
+  -i, --input       specify ts file ('-' reads from stdin)
+  -j, --jobs        number of worker processes for batch mode, or for
+                    scanning a single input file in parallel chunks
+  -m, --mmap        memory-map input file instead of reading it
+  -n, --packets     stop after reading specified number of packets
+  -t, --timeout     stop after specified number of seconds
   -o, --output      specify xml file
-  -p, --print-time  print start time, and end time of specifeid id
+  -p, --print-time  print start time, and end time of specifeid id, may be
+                    repeated or comma separated; with more than one id each
+                    line starts with the id
+  -P, --print-time-file
+                    read the ids for --print-time from file, one per line
+  -S, --store       keep services and events in sqlite3 database, parse only
+                    sections changed since the last run and output from it
   -e, --event-id    output transport_stream_id, servece_id and event_id
+      --stats       write counters and timings of the run to json file
+      --cache-verify
+                    how a repeated section is recognized: none (always
+                    parse), crc (default) or bytes (compare whole section)
+      --profile     run under cProfile and write pstats to specified file
+      --trace-memory
+                    report peak memory and top allocation sites
 ''', file=sys.stderr)
 
+def parse_event_id(s):
+    # TRANSPORT_STREAM_ID:SERVICE_ID:EVENT_ID
+    arr = s.split(':')
+    if len(arr) != 3:
+        raise ValueError('invalid event id: %s' % s)
+    return (int(arr[0]), int(arr[1]), int(arr[2]))
+
+def read_event_ids(filename):
+    event_ids = []
+    f = open(filename)
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            event_ids.append(parse_event_id(line))
+    f.close()
+    return event_ids
+
+def open_input(input_file, use_mmap):
+    if input_file == '-':
+        return TransportStreamFile(sys.stdin.fileno(), 'rb', closefd=False)
+    elif use_mmap:
+        return MappedTransportStreamFile(input_file, 'rb')
+    else:
+        return TransportStreamFile(input_file, 'rb')
+
+def count_events(events):
+    counts = {}
+    for event in tally_events(events, counts):
+        pass
+    return counts
+
+def tally_events(events, counts):
+    # passes the events through, counting them per service
+    for event in events:
+        counts[event.service_id] = counts.get(event.service_id, 0) + 1
+        yield event
+
+def write_stats(filename, stats):
+    f = open(filename, 'w')
+    json.dump(stats, f, indent=2)
+    f.write('\n')
+    f.close()
+
+def write_profile(profiler, filename):
+    profiler.disable()
+    profiler.dump_stats(filename)
+    print("PROFILE: pstats written to %s" % filename, file=sys.stderr)
+
+def report_memory(base):
+    # each allocation is charged to the most recent frame in our own modules
+    (current, peak) = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    sites = {}
+    modules = {} # frame filename -> module file name, or None if not ours
+    for trace in snapshot.statistics('traceback'):
+        for frame in reversed(trace.traceback):
+            module = modules.get(frame.filename, False)
+            if module == False:
+                filename = os.path.abspath(frame.filename)
+                module = os.path.basename(filename) if os.path.dirname(filename) == base else None
+                modules[frame.filename] = module
+            if module != None:
+                site = '%s:%i' % (module, frame.lineno)
+                sites[site] = sites.get(site, 0) + trace.size
+                break
+    print("MEMORY: peak %.1f MiB, current %.1f MiB" % (
+            peak / 1048576.0, current / 1048576.0), file=sys.stderr)
+    top = sorted(sites.items(), key=lambda site: site[1], reverse=True)
+    for (site, size) in top[:TRACE_MEMORY_TOP]:
+        print("MEMORY: %10.1f KiB %s" % (size / 1024.0, site), file=sys.stderr)
+
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'hbsc:dfi:o:p:e', ['help', 'bs', 'cs', 'channel-id=', 'debug', 'format', 'input=', 'output=', 'print-time=', 'event-id'])
+    opts, args = getopt.getopt(sys.argv[1:], 'hbsB:c:dfi:Jj:mn:o:p:P:S:t:e', ['help', 'bs', 'cs', 'batch=', 'channel-id=', 'debug', 'format', 'input=', 'json', 'jobs=', 'mmap', 'packets=', 'output=', 'print-time=', 'print-time-file=', 'store=', 'timeout=', 'event-id', 'stats=', 'profile=', 'trace-memory', 'cache-verify='])
 except (IndexError, getopt.GetoptError):
     usage()
     sys.exit(1)
@@ -38,11 +151,20 @@ channel_id = None
 input_file = None
 output_file = None
 pretty_print = False
+output_json = False
+use_mmap = False
+max_packets = None
+timeout = None
+batch_file = None
+store_file = None
+stats_file = None
+profile_file = None
+trace_memory = False
+verify = CACHE_VERIFY_CRC
+workers = None
 debug = False
 b_type = TYPE_DIGITAL
-transport_stream_id = None
-service_id = None
-event_id = None
+event_ids = []
 output_eid = False
 for o,a in opts:
     if o in ('-h', '--help'):
@@ -52,6 +174,8 @@ for o,a in opts:
         b_type = TYPE_BS
     elif o in ('-s', '--cs'):
         b_type = TYPE_CS
+    elif o in ('-B', '--batch'):
+        batch_file = a
     elif o in ('-c', '--channel-id'):
         channel_id = a
     elif o in ('-d', '--debug'):
@@ -60,43 +184,178 @@ for o,a in opts:
         pretty_print = True
     elif o in ('-i', '--input'):
         input_file = a
+    elif o in ('-J', '--json'):
+        output_json = True
+    elif o in ('-j', '--jobs'):
+        workers = int(a)
+    elif o in ('-m', '--mmap'):
+        use_mmap = True
+    elif o in ('-n', '--packets'):
+        max_packets = int(a)
+    elif o in ('-t', '--timeout'):
+        timeout = float(a)
     elif o in ('-o', '--output'):
         output_file = a
     elif o in ('-p', '--print-time'):
-        arr = a.split(':')
-        transport_stream_id = int(arr[0])
-        service_id = int(arr[1])
-        event_id = int(arr[2])
+        try:
+            event_ids.extend(parse_event_id(s) for s in a.split(','))
+        except ValueError:
+            usage()
+            sys.exit(1)
+    elif o in ('-P', '--print-time-file'):
+        try:
+            event_ids.extend(read_event_ids(a))
+        except (IOError, ValueError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    elif o in ('-S', '--store'):
+        store_file = a
     elif o in ('-e', '--event-id'):
         output_eid = True
+    elif o == '--stats':
+        stats_file = a
+    elif o == '--profile':
+        profile_file = a
+    elif o == '--trace-memory':
+        trace_memory = True
+    elif o == '--cache-verify':
+        if a not in CACHE_VERIFY_NAMES:
+            usage()
+            sys.exit(1)
+        verify = CACHE_VERIFY_NAMES[a]
+stats = {} if stats_file != None else None
+
+# reports are written on exit, whichever mode ends the run
+if trace_memory:
+    tracemalloc.start(TRACE_MEMORY_FRAMES)
+    atexit.register(report_memory, os.path.dirname(os.path.abspath(__file__)))
+if profile_file != None:
+    profiler = cProfile.Profile()
+    atexit.register(write_profile, profiler, profile_file)
+    profiler.enable()
+
+if batch_file != None:
+    if store_file != None:
+        usage()
+        sys.exit(1)
+    try:
+        jobs = read_jobs(batch_file)
+    except (IOError, BatchError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if output_file == None and [job for job in jobs if job.output_file == None]:
+        usage()
+        sys.exit(1)
+    results = run_batch(jobs, workers, debug, use_mmap, verify)
+    start = time.perf_counter()
+    merged = []
+    for result in results:
+        if result.error != None:
+            continue
+        job = result.job
+        if job.output_file != None and output_json:
+            create_ndjson(job.b_type, job.channel_id, result.service, result.events,
+                    job.output_file)
+        elif job.output_file != None:
+            create_xml(job.b_type, job.channel_id, result.service, result.events,
+                    job.output_file, pretty_print, output_eid)
+        else:
+            merged.append((job.b_type, job.channel_id, result.service, result.events))
+    if output_file != None and output_json:
+        create_merged_ndjson(merged, output_file)
+    elif output_file != None:
+        create_merged_xml(merged, output_file, pretty_print, output_eid)
+    if stats_file != None:
+        stats['jobs'] = []
+        for result in results:
+            job_stats = {'input_file':result.job.input_file, 'error':result.error,
+                    'elapsed_seconds':round(result.elapsed, 6)}
+            if result.error == None:
+                job_stats.update(result.stats)
+                job_stats['services'] = len(result.service)
+                job_stats['events'] = len(result.events)
+                job_stats['events_per_service'] = count_events(result.events)
+            stats['jobs'].append(job_stats)
+        stats['write_seconds'] = round(time.perf_counter() - start, 6)
+        write_stats(stats_file, stats)
+    sys.exit(1 if [result for result in results if result.error != None] else 0)
 
-if service_id == None and (
+if not event_ids and (
         (b_type == TYPE_DIGITAL and channel_id == None) or input_file == None or output_file == None):
     usage()
     sys.exit(1)
-elif input_file == None:
+elif input_file == None or (use_mmap and input_file == '-'):
+    usage()
+    sys.exit(1)
+elif store_file != None and (workers != None or event_ids):
     usage()
     sys.exit(1)
 
-tsfile = TransportStreamFile(input_file, 'rb')
-(service, events) = parse_ts(b_type, tsfile, debug)
-tsfile.close()
-if service_id == None:
-    create_xml(b_type, channel_id, service, events, output_file, pretty_print, output_eid)
+if event_ids:
+    # only the EIT event headers are read, until every id has been seen
+    tsfile = open_input(input_file, use_mmap)
+    found = find_events(tsfile, event_ids, debug, max_packets, timeout, stats, verify)
+    tsfile.close()
+    if stats_file != None:
+        write_stats(stats_file, stats)
+    missing = False
+    for (transport_stream_id, service_id, event_id) in event_ids:
+        times = found.get((transport_stream_id, service_id, event_id))
+        if times == None:
+            print("not found: transport_stream_id=%d service_id=%d event_id=%d" %
+                    (transport_stream_id, service_id, event_id), file=sys.stderr)
+            missing = True
+            continue
+        (start_time, duration) = times
+        end_time = start_time + duration
+        times = (int(time.mktime(start_time.timetuple())), int(time.mktime(end_time.timetuple())))
+        if len(event_ids) == 1:
+            print(*times)
+        else:
+            print('%d:%d:%d' % (transport_stream_id, service_id, event_id), *times)
+    sys.exit(1 if missing else 0)
+
+# only a regular file can be split into chunks, a pipe is read serially
+parallel = workers != None and input_file != '-' and os.path.isfile(input_file)
+if output_json and b_type != TYPE_DIGITAL and store_file == None and not parallel:
+    # BS/CS records are written out as each service's schedule completes
+    tsfile = open_input(input_file, use_mmap)
+    collector = EpgCollector(b_type, debug, verify)
+    counts = {}
+    events = iter_epg(b_type, tsfile, debug, max_packets, timeout, collector, stats=stats)
+    create_ndjson(b_type, channel_id, collector.service_map, tally_events(events, counts),
+            output_file)
+    tsfile.close()
+    if stats_file != None:
+        stats['services'] = len(collector.service_map)
+        stats['events'] = sum(counts.values())
+        stats['events_per_service'] = counts
+        write_stats(stats_file, stats)
+    sys.exit(0)
+
+if parallel:
+    (service, events) = parse_ts_parallel(b_type, input_file, workers, debug, max_packets, use_mmap,
+            stats, verify, timeout)
 else:
-    start_time = None
-    end_time = None
-    for event in events:
-        if (event.transport_stream_id == transport_stream_id and
-            event.service_id == service_id and
-            event.event_id == event_id):
-            start_time = event.start_time
-            end_time = event.start_time + event.duration
-            break
-    if start_time == None:
-        print("not found: transport_stream_id=%d service_id=%d event_id=%d" %
-                (transport_stream_id, service_id, event_id), file=sys.stderr)
-        sys.exit(1)
+    tsfile = open_input(input_file, use_mmap)
+    if store_file != None:
+        store = EpgStore(store_file)
+        (service, events) = parse_ts_store(b_type, tsfile, store, debug, max_packets, timeout,
+                stats, verify)
+        store.close()
     else:
-        print(int(time.mktime(start_time.timetuple())),
-                int(time.mktime(end_time.timetuple())))
+        (service, events) = parse_ts(b_type, tsfile, debug, max_packets, timeout, stats=stats,
+                verify=verify)
+    tsfile.close()
+if stats_file != None:
+    stats['services'] = len(service)
+    stats['events'] = len(events)
+    stats['events_per_service'] = count_events(events)
+start = time.perf_counter()
+if output_json:
+    create_ndjson(b_type, channel_id, service, events, output_file)
+else:
+    create_xml(b_type, channel_id, service, events, output_file, pretty_print, output_eid)
+if stats_file != None:
+    stats['write_seconds'] = round(time.perf_counter() - start, 6)
+    write_stats(stats_file, stats)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import sqlite3
+import datetime
+from functools import cmp_to_key
+
+from constant import *
+from aribtable import *
+from parser import EpgCollector
+from parser import parse_ts
+from parser import compare_event
+from parser import compare_service
+from parser import fix_events
+
+# an EIT schedule never reaches further ahead than this
+SCHEDULE_SPAN = datetime.timedelta(days=8)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS section (
+    table_id INTEGER NOT NULL,
+    original_network_id INTEGER NOT NULL,
+    transport_stream_id INTEGER NOT NULL,
+    service_id INTEGER NOT NULL,
+    section_number INTEGER NOT NULL,
+    version_number INTEGER NOT NULL,
+    fingerprint BLOB NOT NULL,
+    PRIMARY KEY (table_id, original_network_id, transport_stream_id,
+        service_id, section_number)
+);
+CREATE TABLE IF NOT EXISTS section_event (
+    table_id INTEGER NOT NULL,
+    original_network_id INTEGER NOT NULL,
+    transport_stream_id INTEGER NOT NULL,
+    service_id INTEGER NOT NULL,
+    section_number INTEGER NOT NULL,
+    event_id INTEGER NOT NULL,
+    PRIMARY KEY (table_id, original_network_id, transport_stream_id,
+        service_id, section_number, event_id)
+);
+CREATE INDEX IF NOT EXISTS section_event_id ON section_event (
+    transport_stream_id, event_id, service_id);
+CREATE TABLE IF NOT EXISTS service (
+    transport_stream_id INTEGER NOT NULL,
+    service_id INTEGER NOT NULL,
+    service_name TEXT,
+    PRIMARY KEY (transport_stream_id, service_id)
+);
+CREATE TABLE IF NOT EXISTS event (
+    transport_stream_id INTEGER NOT NULL,
+    service_id INTEGER NOT NULL,
+    event_id INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    duration INTEGER NOT NULL,
+    running_status INTEGER,
+    free_CA_mode INTEGER,
+    title TEXT,
+    text TEXT,
+    extended TEXT,
+    content TEXT,
+    PRIMARY KEY (transport_stream_id, service_id, event_id)
+);
+'''
+
+UPSERT_SECTION = '''
+INSERT INTO section VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (table_id, original_network_id, transport_stream_id, service_id, section_number)
+DO UPDATE SET
+    version_number = excluded.version_number,
+    fingerprint = excluded.fingerprint
+'''
+
+# sections of an older version of a table the stream has moved on from,
+# or past the last section of the table as sent now
+DELETE_STALE_SECTION = '''
+DELETE FROM section WHERE table_id = ? AND original_network_id = ?
+    AND transport_stream_id = ? AND service_id = ?
+    AND (version_number != ? OR section_number > ?)
+'''
+
+DELETE_SECTION_EVENTS = '''
+DELETE FROM section_event WHERE table_id = ? AND original_network_id = ?
+    AND transport_stream_id = ? AND service_id = ? AND section_number = ?
+'''
+
+INSERT_SECTION_EVENT = 'INSERT OR IGNORE INTO section_event VALUES (?, ?, ?, ?, ?, ?)'
+
+DELETE_ORPHAN_SECTION_EVENTS = '''
+DELETE FROM section_event WHERE NOT EXISTS (SELECT 1 FROM section
+    WHERE section.table_id = section_event.table_id
+    AND section.original_network_id = section_event.original_network_id
+    AND section.transport_stream_id = section_event.transport_stream_id
+    AND section.service_id = section_event.service_id
+    AND section.section_number = section_event.section_number)
+'''
+
+# events no stored section lists any more were removed by the broadcaster,
+# GR events are merged across services so only the event id has to match
+DELETE_UNLISTED_EVENTS = '''
+DELETE FROM event WHERE NOT EXISTS (SELECT 1 FROM section_event
+    WHERE section_event.transport_stream_id = event.transport_stream_id
+    AND section_event.event_id = event.event_id
+    AND (? OR section_event.service_id = event.service_id))
+'''
+
+UPSERT_SERVICE = '''
+INSERT INTO service VALUES (?, ?, ?)
+ON CONFLICT (transport_stream_id, service_id)
+DO UPDATE SET
+    service_name = COALESCE(excluded.service_name, service_name)
+'''
+
+# descriptors missing from the sections parsed this run keep their stored value
+UPSERT_EVENT = '''
+INSERT INTO event VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (transport_stream_id, service_id, event_id)
+DO UPDATE SET
+    start_time = excluded.start_time,
+    end_time = excluded.end_time,
+    duration = excluded.duration,
+    running_status = excluded.running_status,
+    free_CA_mode = excluded.free_CA_mode,
+    title = COALESCE(excluded.title, title),
+    text = COALESCE(excluded.text, text),
+    extended = COALESCE(excluded.extended, extended),
+    content = COALESCE(excluded.content, content)
+'''
+
+class EpgStore:
+    # Services, events and EIT section versions kept across runs in sqlite3
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        created = self.db.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'section_event'").fetchone() == None
+        self.db.executescript(SCHEMA)
+        if created:
+            # sections stored without their events are parsed once more
+            with self.db:
+                self.db.execute('DELETE FROM section')
+    def close(self):
+        self.db.close()
+    def sections(self):
+        # section cache key -> fingerprint of every EIT section stored so far
+        known = {}
+        for row in self.db.execute('SELECT * FROM section'):
+            (table_id, original_network_id, transport_stream_id, service_id,
+                    section_number, version_number, fingerprint) = row
+            key = (table_id, original_network_id, transport_stream_id, service_id,
+                    section_number, version_number)
+            known[key] = bytes(fingerprint)
+        return known
+    def update(self, collector, events):
+        # sections still pending were never parsed, they are left for a later run
+        pending = set()
+        for t_packet in collector.pending:
+            pending.add(collector.cache.key(t_packet.binary_data))
+        sections = []
+        for (key, fingerprint) in collector.cache.sections.items():
+            if key[0] in SDT_TABLE_ID or key in pending:
+                continue
+            sections.append(key + (fingerprint,))
+        # events of the sections parsed this run, unchanged ones keep theirs
+        stale = []
+        section_events = []
+        for (key, (last_section_number, event_ids)) in collector.section_events.items():
+            stale.append(key[:4] + (key[5], last_section_number))
+            for event_id in event_ids:
+                section_events.append(key[:5] + (event_id,))
+        services = []
+        for (service_id, service_name) in collector.service_map.items():
+            transport_stream_id = collector.transport_stream_ids[service_id]
+            services.append((transport_stream_id, service_id, service_name))
+        rows = []
+        latest = None
+        for event in events:
+            rows.append(event_row(event))
+            if event.start_time.year < 9999 and (latest == None or event.start_time > latest):
+                latest = event.start_time
+        with self.db:
+            self.db.executemany(DELETE_STALE_SECTION, stale)
+            self.db.executemany(UPSERT_SECTION, sections)
+            self.db.executemany(DELETE_SECTION_EVENTS,
+                    [key[:5] for key in collector.section_events])
+            self.db.executemany(INSERT_SECTION_EVENT, section_events)
+            self.db.execute(DELETE_ORPHAN_SECTION_EVENTS)
+            self.db.executemany(UPSERT_SERVICE, services)
+            self.db.executemany(UPSERT_EVENT, rows)
+            self.db.execute(DELETE_UNLISTED_EVENTS, (collector.b_type == TYPE_DIGITAL,))
+            if latest != None:
+                self.db.execute('DELETE FROM event WHERE end_time < ?',
+                        (str(latest - SCHEDULE_SPAN),))
+    def events(self, b_type, transport_stream_ids):
+        # stored events of the given services, in the order parse_ts returns them
+        events = []
+        # events only known from extended descriptors so far are left out, as fix_events does
+        for row in self.db.execute('SELECT * FROM event WHERE title IS NOT NULL ORDER BY rowid'):
+            if transport_stream_ids.get(row[1]) == row[0]:
+                events.append(row_event(row))
+        if b_type == TYPE_DIGITAL:
+            return sorted(events, key=cmp_to_key(compare_event))
+        else:
+            return sorted(events, key=cmp_to_key(compare_service))
+
+def event_row(event):
+    (title, text) = (None, None)
+    if event.desc_short != None:
+        (title, text) = (event.desc_short.event_name, event.desc_short.text)
+    extended = None
+    if event.desc_extend != None:
+        extended = json.dumps(list(event.desc_extend.items()), ensure_ascii=False)
+    content = None
+    if event.desc_content != None:
+        content = json.dumps([(ct.content_nibble_level_1, ct.content_nibble_level_2,
+            ct.user_nibble_1, ct.user_nibble_2)
+            for ct in event.desc_content.content_type_array], ensure_ascii=False)
+    return (event.transport_stream_id, event.service_id, event.event_id,
+            str(event.start_time), str(event.start_time + event.duration),
+            int(event.duration.total_seconds()), event.running_status,
+            event.free_CA_mode, title, text, extended, content)
+
+def row_event(row):
+    (transport_stream_id, service_id, event_id, start_time, end_time, duration,
+            running_status, free_CA_mode, title, text, extended, content) = row
+    event = Event(transport_stream_id, service_id, event_id,
+            datetime.datetime.fromisoformat(start_time),
+            datetime.timedelta(seconds=duration), running_status, free_CA_mode, 0)
+    event.desc_short = ShortEventDescriptor(TAG_SED, 0, 'jpn', 0, None, 0, None)
+    event.desc_short.event_name = title
+    event.desc_short.text = text
+    if extended != None:
+        event.desc_extend = dict(json.loads(extended))
+    if content != None:
+        event.desc_content = ContentDescriptor(TAG_CD, 0,
+                [ContentType(*ct) for ct in json.loads(content)])
+    return event
+
+def parse_ts_store(b_type, tsfile, store, debug, max_packets=None, timeout=None, stats=None,
+        verify=CACHE_VERIFY_CRC):
+    # only EIT sections whose version changed since the last run are parsed,
+    # the returned schedule is read back from the store
+    collector = EpgCollector(b_type, debug, verify)
+    collector.cache.known.update(store.sections())
+    collector.section_events = {}
+    (service, events) = parse_ts(b_type, tsfile, debug, max_packets, timeout, collector, stats)
+    # events of changed extended schedule sections alone have no short event
+    # descriptor, their text is merged into the stored row
+    events += fix_events([event for event in collector.event_map.values()
+            if event.desc_short == None], True)
+    store.update(collector, events)
+    print("STORE: %i sections unchanged, %i events updated" % (
+            collector.unchanged, len(events)), file=sys.stderr)
+    return (service, store.events(b_type, collector.transport_stream_ids))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+
+from constant import *
+from xmltv import get_text
+
+
+class NdjsonWriter:
+    # Writes one JSON object per line so readers can consume records as they arrive
+    def __init__(self, fd):
+        self.fd = fd
+    def write(self, record):
+        self.fd.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+
+def open_output(filename):
+    if filename == '-':
+        return sys.stdout.buffer
+    return open(filename, 'wb')
+
+def create_ndjson(b_type, channel_id, service, events, filename):
+    # events may be an iterator still filling service, as from parser.iter_epg;
+    # then the channels known so far go before each programme and every record
+    # is flushed, so readers get each service as soon as its schedule completes
+    fd = open_output(filename)
+    writer = NdjsonWriter(fd)
+    streaming = iter(events) is events
+    written = 0
+    for record in create_event_records(channel_id, events, b_type):
+        written = write_new_channels(writer, b_type, channel_id, service, written)
+        writer.write(record)
+        if streaming:
+            fd.flush()
+    write_new_channels(writer, b_type, channel_id, service, written)
+    if fd is not sys.stdout.buffer:
+        fd.close()
+
+def write_new_channels(writer, b_type, channel_id, service, written):
+    # services are only ever added, so the first written ones are done
+    if len(service) > written:
+        for record in create_channel_records(b_type, channel_id,
+                dict(list(service.items())[written:])):
+            writer.write(record)
+    return len(service)
+
+def create_merged_ndjson(results, filename):
+    # results: list of (b_type, channel_id, service, events)
+    fd = open_output(filename)
+    writer = NdjsonWriter(fd)
+    for (b_type, channel_id, service, events) in results:
+        for record in create_channel_records(b_type, channel_id, service):
+            writer.write(record)
+    for (b_type, channel_id, service, events) in results:
+        for record in create_event_records(channel_id, events, b_type):
+            writer.write(record)
+    if fd is not sys.stdout.buffer:
+        fd.close()
+
+def create_channel_records(b_type, channel_id, service):
+    for (service_id, service_name) in service.items():
+        ch = b_type + str(service_id) if channel_id == None else channel_id
+        yield {
+                'type':'channel',
+                'id':ch,
+                'service_id':service_id,
+                'name':get_text(service_name)}
+
+def create_event_records(channel_id, events, b_type):
+    t_format = '%Y-%m-%dT%H:%M:%S+09:00'
+    for event in events:
+        ch = b_type + str(event.service_id) if channel_id == None else channel_id
+        # short event text is the symbols of the event name, a newline and the text
+        (symbols, desc) = get_text(event.desc_short.text).split('\n', 1)
+        extended = {}
+        if event.desc_extend != None:
+            for (k,v) in event.desc_extend.items():
+                extended[get_text(k)] = get_text(v)
+        genres = []
+        if event.desc_content != None:
+            for ct in event.desc_content.content_type_array:
+                for genre in (ct.content_nibble_level_1, ct.content_nibble_level_2):
+                    if genre not in genres and genre != 'UNKNOWN':
+                        genres.append(genre)
+        yield {
+                'type':'programme',
+                'channel':ch,
+                'transport_stream_id':event.transport_stream_id,
+                'service_id':event.service_id,
+                'event_id':event.event_id,
+                'start':event.start_time.strftime(t_format),
+                'stop':(event.start_time + event.duration).strftime(t_format),
+                'title':get_text(event.desc_short.event_name),
+                'symbols':symbols,
+                'desc':desc,
+                'extended':extended,
+                'genres':genres}
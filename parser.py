@@ -1,69 +1,493 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import io
-import array
+import time
+import mmap
+import stat
+import select
 import datetime
 import copy
+import collections
 from functools import cmp_to_key
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from constant import *
 from aribtable import *
-from aribstr import AribString
+from aribstr import arib_utf, ARIB_CACHE
 
 
-class TransportStreamFile(io.FileIO):
+PID_FILTER_TABLES = {}
+
+def get_pid_filter_tables(pids):
+    # per upper PID byte: translate tables flagging the upper and lower byte
+    tables = PID_FILTER_TABLES.get(pids)
+    if tables == None:
+        tables = []
+        for high in sorted(set(pid >> 8 for pid in pids)):
+            lows = set(pid & 0xFF for pid in pids if pid >> 8 == high)
+            tables.append((
+                bytes(1 if (i & 0x1F) == high else 0 for i in range(256)),
+                bytes(1 if i in lows else 0 for i in range(256))))
+        PID_FILTER_TABLES[pids] = tables
+    return tables
+
+def scan_pids_numpy(buffer, pos, count, pids):
+    packets = numpy.frombuffer(buffer, numpy.uint8, count * TS_PACKET_SIZE, pos)
+    packets = packets.reshape(count, TS_PACKET_SIZE)
+    lost = numpy.flatnonzero(packets[:, 0] != 0x47)
+    if len(lost):
+        count = int(lost[0])
+        packets = packets[:count]
+    pid = ((packets[:, 1].astype(numpy.uint16) & 0x1F) << 8) | packets[:, 2]
+    return (count, numpy.flatnonzero(numpy.isin(pid, pids)).tolist())
+
+def scan_pids_bytes(buffer, pos, count, pids):
+    end = pos + count * TS_PACKET_SIZE
+    sync = buffer[pos:end:TS_PACKET_SIZE]
+    count = len(sync) - len(sync.lstrip(b'\x47'))
+    end = pos + count * TS_PACKET_SIZE
+    high = buffer[pos + 1:end:TS_PACKET_SIZE]
+    low = buffer[pos + 2:end:TS_PACKET_SIZE]
+    flags = 0
+    for (high_table, low_table) in get_pid_filter_tables(pids):
+        flags |= (int.from_bytes(high.translate(high_table), 'big') &
+                int.from_bytes(low.translate(low_table), 'big'))
+    flags = flags.to_bytes(count, 'big')
+    found = []
+    idx = flags.find(1)
+    while idx >= 0:
+        found.append(idx)
+        idx = flags.find(1, idx + 1)
+    return (count, found)
+
+scan_pids = scan_pids_numpy if numpy else scan_pids_bytes
+
+class TransportStreamBuffer:
+    # Packet iteration over a buffer refilled by fill_buffer()
+    def __init__(self):
+        self.pid_filter = None
+        self.count = 0   # packets up to the last one returned
+        self.scanned = 0 # packets up to the current position
+        self.bytes_read = 0
+        self.sync_losses = 0
+        self.deadline = None # fill_buffer() gives up at this time.monotonic()
+        self.reset_buffer()
+    def reset_buffer(self):
+        self.buffer = b''
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+        self.found = collections.deque()
+    def set_pid_filter(self, pids):
+        # skip packets of other PIDs in bulk; count still includes them
+        self.pid_filter = tuple(sorted(pids)) if pids != None else None
+        if self.found:
+            self.pos = self.found[0][0]
+            self.scanned = self.found[0][1] - 1
+            self.found.clear()
+    def scan_buffer(self, limit=0):
+        # one block of at most SCAN_PACKETS_MAX packets, not past packet limit
+        pos = self.pos
+        if pos + TS_PACKET_SIZE > len(self.buffer) or self.buffer[pos] != 0x47:
+            pos = self.resync(limit)
+        count = min((len(self.buffer) - pos) // TS_PACKET_SIZE, SCAN_PACKETS_MAX)
+        if limit:
+            count = max(min(count, limit - self.scanned), 0)
+        (count, found) = scan_pids(self.buffer, pos, count, self.pid_filter)
+        for idx in found:
+            self.found.append((pos + idx * TS_PACKET_SIZE, self.scanned + idx + 1))
+        self.scanned += count
+        self.pos = pos + count * TS_PACKET_SIZE
+    def append_buffer(self, data):
+        self.bytes_read += len(data)
+        self.buffer = self.buffer[self.pos:] + data
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+    def resync(self, limit=0):
+        # skipped bytes count as packets, rounded up, toward the packet limit
+        skipped = 0
+        while True:
+            pos = self.buffer.find(b'\x47', self.pos)
+            if pos < 0:
+                pos = len(self.buffer)
+            skipped += pos - self.pos
+            self.pos = pos
+            if pos + TS_PACKET_SIZE <= len(self.buffer):
+                if skipped:
+                    self.sync_losses += 1
+                    self.scanned += -(-skipped // TS_PACKET_SIZE)
+                return pos
+            if limit and self.scanned + skipped // TS_PACKET_SIZE >= limit:
+                if skipped:
+                    self.sync_losses += 1
+                self.scanned = limit
+                raise StopIteration
+            if not self.fill_buffer():
+                raise StopIteration
+    def next_pos(self):
+        if self.found:
+            return self.found[0][0]
+        return self.pos
     def __iter__(self):
         return self
     def __next__(self):
-        try:
-            sync = self.read(1)
-            while ord(sync) != 0x47:
-                sync = self.read(1)
-        except TypeError:
-            raise StopIteration
-        data = self.read(187)
-        packet = array.array('B', data)
-        packet.insert(0, ord(sync))
-        if len(packet) != 188:
-            raise StopIteration
-        return packet
+        while True:
+            b_packet = self.read_packet()
+            if b_packet != None:
+                return b_packet
+    def read_packet(self, limit=0):
+        # the next packet, or None when a block scanned by the PID filter had
+        # none or packet limit is reached, so the caller can check its budgets
+        if self.pid_filter != None:
+            if not self.found:
+                if limit and self.scanned >= limit:
+                    self.count = self.scanned
+                    return None
+                try:
+                    self.scan_buffer(limit)
+                except StopIteration:
+                    self.count = self.scanned
+                    raise
+                if not self.found:
+                    self.count = self.scanned
+                    return None
+            (pos, self.count) = self.found.popleft()
+            return self.view[pos:pos + TS_PACKET_SIZE]
+        pos = self.pos
+        if pos + TS_PACKET_SIZE > len(self.buffer) or self.buffer[pos] != 0x47:
+            try:
+                pos = self.resync(limit)
+            except StopIteration:
+                self.count = self.scanned
+                raise
+        self.pos = pos + TS_PACKET_SIZE
+        self.scanned += 1
+        self.count = self.scanned
+        return self.view[pos:self.pos]
+
+class TransportStreamFile(TransportStreamBuffer, io.FileIO):
+    def __init__(self, name, mode='rb', closefd=True, buffer_size=READ_BUFFER_SIZE):
+        io.FileIO.__init__(self, name, mode, closefd)
+        TransportStreamBuffer.__init__(self)
+        self.buffer_size = max(buffer_size - buffer_size % TS_PACKET_SIZE, TS_PACKET_SIZE)
+        self.pollable = not stat.S_ISREG(os.fstat(self.fileno()).st_mode)
+    def fill_buffer(self):
+        # a pipe is waited on only until the deadline, so it also bounds a live stream
+        if self.deadline != None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.pollable and not select.select([self], [], [], remaining)[0]:
+                return False
+        data = self.read(self.buffer_size)
+        if not data:
+            return False
+        self.append_buffer(data)
+        return True
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset -= len(self.buffer) - self.next_pos()
+        self.reset_buffer()
+        return io.FileIO.seek(self, offset, whence)
+    def tell(self):
+        return io.FileIO.tell(self) - (len(self.buffer) - self.next_pos())
+
+class TransportStreamChunks(TransportStreamBuffer):
+    # Packets of chunks pushed by the caller, iteration stops when they run out
+    # and resumes after the next feed(); a partial packet waits for the rest
+    def __init__(self):
+        TransportStreamBuffer.__init__(self)
+        self.chunks = []
+    def feed(self, data):
+        self.chunks.append(data)
+    def fill_buffer(self):
+        if not self.chunks:
+            return False
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        self.append_buffer(data)
+        return True
+
+class MappedTransportStreamFile(TransportStreamFile):
+    map = b''
+    def __init__(self, name, mode='rb', closefd=True):
+        TransportStreamFile.__init__(self, name, mode, closefd)
+        if os.fstat(self.fileno()).st_size > 0:
+            self.map = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self.map, 'madvise'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.bytes_read = len(self.map) # mapped at once
+        self.reset_buffer()
+    def reset_buffer(self):
+        self.buffer = self.map
+        self.view = memoryview(self.map)
+        self.pos = 0
+        self.found = collections.deque()
+    def fill_buffer(self):
+        return False
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.next_pos()
+        elif whence == io.SEEK_END:
+            offset += len(self.map)
+        self.found.clear()
+        self.pos = min(max(offset, 0), len(self.map))
+        return self.pos
+    def tell(self):
+        return self.next_pos()
+    def close(self):
+        self.view.release()
+        if self.map:
+            try:
+                self.map.close()
+            except BufferError:
+                # packets still referenced; the mapping goes away with them
+                pass
+        TransportStreamFile.close(self)
+
+class SectionCache:
+    def __init__(self, verify=CACHE_VERIFY_CRC):
+        self.verify = verify
+        self.sections = {}
+        self.repeated = set()
+        self.known = {}
+        self.count = 0
+    def key(self, data):
+        table_id = data[5]
+        section_number = data[11]
+        version_number = ((data[10] >> 1) & 0x1F)
+        if table_id in SDT_TABLE_ID:
+            transport_stream_id = (data[8] << 8) + data[9]
+            original_network_id = (data[13] << 8) + data[14]
+            return (table_id, original_network_id, transport_stream_id, section_number, version_number)
+        service_id = (data[8] << 8) + data[9]
+        transport_stream_id = (data[13] << 8) + data[14]
+        original_network_id = (data[15] << 8) + data[16]
+        return (table_id, original_network_id, transport_stream_id, service_id, section_number, version_number)
+    def fingerprint(self, data):
+        end = (((data[6] & 0x0F) << 8) + data[7]) + 8
+        if self.verify == CACHE_VERIFY_BYTES:
+            # repeats are trusted only if they match the verified copy byte for byte
+            return data[5:end].tobytes()
+        # CRC_32 field at the end of the section
+        return data[end - 4:end].tobytes()
+    def lookup(self, data):
+        key = self.key(data)
+        fingerprint = self.sections.get(key)
+        if fingerprint == None:
+            return False
+        if self.verify != CACHE_VERIFY_NONE and fingerprint != self.fingerprint(data):
+            return False
+        self.repeated.add(key)
+        self.count += 1
+        return True
+    def add(self, data):
+        self.sections[self.key(data)] = self.fingerprint(data)
+    def unchanged(self, data):
+        # same section, version and fingerprint as one stored by an earlier run
+        return self.known.get(self.key(data)) == self.fingerprint(data)
+
+class ServiceTableTracker:
+    # Tracks which SDT sections have been seen to tell when the service map is complete
+    def __init__(self):
+        self.tables = {} # (table_id, original_network_id, transport_stream_id) -> [version, last_section_number, sections]
+        self.first = None
+    def add(self, sdt, key):
+        if self.first == None:
+            self.first = key
+        table_key = (sdt.table_id, sdt.original_network_id, sdt.transport_stream_id)
+        table = self.tables.get(table_key)
+        if table == None or table[0] != sdt.version_number:
+            table = [sdt.version_number, sdt.last_section_number, set()]
+            self.tables[table_key] = table
+        table[1] = sdt.last_section_number
+        table[2].add(sdt.section_number)
+    def is_complete(self, cache):
+        # the carousel has come around once the first section seen is repeated
+        if self.first == None or self.first not in cache.repeated:
+            return False
+        actual = False
+        for (table_key, table) in self.tables.items():
+            if table_key[0] == SDT_TABLE_ID[0]:
+                actual = True
+            for section_number in range(table[1] + 1):
+                if section_number not in table[2]:
+                    return False
+        return actual
+
+class EventTableTracker:
+    # Tracks which EIT sections have been seen to tell when the schedule is complete
+    def __init__(self):
+        self.tables = {}     # (service_id, table_id) -> [version, last_section_number, segments, sections]
+        self.groups = {}     # service_id -> {first table_id: last_table_id}
+        self.first = {}      # service_id -> {pid: cache key of the first section seen}
+        self.complete = set()
+    def add(self, eit, key, pid):
+        firsts = self.first.setdefault(eit.service_id, {})
+        first = firsts.get(pid)
+        if first == None or (first[:5] == key[:5] and first[5] != key[5]):
+            # after a new version of the first section, that one has to come around
+            firsts[pid] = key
+        table_id = eit.table_id
+        if table_id in EIT_PF_TABLE_ID:
+            first = table_id
+        else:
+            first = table_id & 0xF8
+        groups = self.groups.setdefault(eit.service_id, {})
+        groups[first] = max(eit.last_table_id, table_id)
+        key = (eit.service_id, table_id)
+        table = self.tables.get(key)
+        if table == None or table[0] != eit.version_number:
+            table = [eit.version_number, eit.last_section_number, {}, set()]
+            self.tables[key] = table
+        table[1] = eit.last_section_number
+        table[2][eit.section_number >> 3] = eit.segment_last_section_number
+        table[3].add(eit.section_number)
+        self.complete.discard(eit.service_id)
+    def is_table_complete(self, table):
+        (version, last_section_number, segments, sections) = table
+        for segment in range((last_section_number >> 3) + 1):
+            segment_last = segments.get(segment)
+            if segment_last == None:
+                return False
+            for section_number in range(segment << 3, min(segment_last, last_section_number) + 1):
+                if section_number not in sections:
+                    return False
+        return True
+    def is_service_complete(self, service_id, cache):
+        if service_id in self.complete:
+            return True
+        # the carousel of every PID carrying the service has come around once,
+        # so the extended schedule had its chance to show up
+        firsts = self.first.get(service_id, {})
+        for key in firsts.values():
+            if key not in cache.repeated:
+                return False
+        groups = self.groups.get(service_id, {})
+        # present/following and basic schedule are mandatory, extended only if seen
+        if not (0x4E in groups or 0x4F in groups):
+            return False
+        if not (0x50 in groups or 0x60 in groups):
+            return False
+        for (first, last) in groups.items():
+            for table_id in range(first, last + 1):
+                table = self.tables.get((service_id, table_id))
+                if table == None or not self.is_table_complete(table):
+                    return False
+        self.complete.add(service_id)
+        return True
+    def is_complete(self, service_ids, cache):
+        if not service_ids:
+            return False
+        for service_id in service_ids:
+            if not self.is_service_complete(service_id, cache):
+                return False
+        return True
 
 class TransportPacketParser:
-    def __init__(self, tsfile, pid, debug=False):
+    def __init__(self, tsfile, pid, debug=False, cache=None, complete=None,
+            max_packets=None, timeout=None):
         self.tsfile = tsfile
         self.pid = pid
+        self.tsfile.set_pid_filter(pid)
+        self.start = tsfile.count
+        self.cache = cache
+        self.complete = complete
         self.section_map = {}
-        self.queue = []
         self.debug = debug
+        if max_packets == None:
+            max_packets = 0 if debug else READ_PACKETS_MAX
+        self.max_packets = max_packets
+        self.deadline = None
+        if timeout:
+            self.deadline = time.monotonic() + timeout
+        tsfile.deadline = self.deadline
+        self.check = 0
         self.count = 0
+        self.repeated = 0
+        self.done = False
+        self.pid_count = collections.Counter() # packets of the PIDs parsed
+        self.section_count = 0
+        self.dropped = 0
+        self.crc_errors = 0
+        self.stream = self.read_tables(self.read_sections(self.read_packets()))
     def __iter__(self):
         return self
     def __next__(self):
-        while True:
+        return self.stream.__next__()
+
+    def read_packets(self):
+        # packets of the filtered PIDs until EOF, a limit or a complete table set
+        limit = self.start + self.max_packets if self.max_packets else 0
+        while not self.done:
+            if self.max_packets and self.count >= self.max_packets:
+                self.done = True
+                return
             try:
-                return self.queue.pop(0)
-            except IndexError:
-                pass
-            b_packet = self.tsfile.__next__()
-            self.count += 1
-            if not self.debug:
-                if self.count >= READ_PACKETS_MAX:
-                    raise StopIteration
+                b_packet = self.tsfile.read_packet(limit)
+            except StopIteration:
+                # the read gave up at the deadline, or the stream ended
+                if self.deadline != None and time.monotonic() >= self.deadline:
+                    self.done = True
+                return
+            finally:
+                self.count = self.tsfile.count - self.start
+            if self.deadline != None and self.count >= self.check:
+                self.check = self.count + 1024
+                if time.monotonic() >= self.deadline:
+                    self.done = True
+                    return
+            if b_packet != None:
+                yield b_packet
+
+    def read_sections(self, packets):
+        # (header, section data) of every section not already in the cache
+        for b_packet in packets:
             header = self.parse_header(b_packet)
-            if header.pid in self.pid and header.adaptation_field_control == 1:
-                while True:
-                    (next_packet, section) = self.parse_section(header, self.section_map, b_packet)
-                    if next_packet:
+            self.pid_count[header.pid] += 1
+            if header.pid not in self.pid or header.adaptation_field_control != 1:
+                continue
+            while True:
+                (next_packet, section) = self.parse_section(header, self.section_map, b_packet)
+                if next_packet:
+                    break
+                if section:
+                    self.section_count += 1
+                    if self.cache != None and self.cache.lookup(section.data):
+                        # a section repeated for the first time may complete a table
+                        if self.complete != None and self.repeated != len(self.cache.repeated):
+                            self.repeated = len(self.cache.repeated)
+                            self.done = self.complete()
+                        continue
+                    yield (header, section.data)
+                    if header.pid not in self.section_map:
+                        # rejected by read_tables, the rest of the packet is lost
                         break
-                    if section:
-                        try:
-                            t_packet = TransportPacket(header, section.data)
-                            self.queue.append(t_packet)
-                        except CRC32MpegError as e:
-                            print('CRC32MpegError', e, file=sys.stderr)
-                            self.section_map.pop(header.pid)
-                            break
+
+    def read_tables(self, sections):
+        # CRC checked sections as SDT/EIT transport packets
+        for (header, data) in sections:
+            try:
+                t_packet = TransportPacket(header, data)
+            except CRC32MpegError as e:
+                # a noisy signal fails many sections, only the first ones are shown
+                self.crc_errors += 1
+                self.dropped += 1
+                if self.crc_errors <= CRC_ERROR_MESSAGES_MAX:
+                    print('CRC32MpegError', e, file=sys.stderr)
+                self.section_map.pop(header.pid)
+                continue
+            if self.cache != None:
+                self.cache.add(data)
+            yield t_packet
+
+    def set_pid(self, pid):
+        self.pid = pid
+        self.tsfile.set_pid_filter(pid)
 
     def parse_header(self, b_packet):
         pid = ((b_packet[1] & 0x1F) << 8) + b_packet[2]
@@ -81,6 +505,7 @@ class TransportPacketParser:
             if sect.length_total == 0:
                 section_length = 180
                 if header.pointer_field > 179:
+                    self.dropped += 1
                     next_packet = True
                     sect = None
                 else:
@@ -88,16 +513,17 @@ class TransportPacketParser:
                     section_length -= header.pointer_field
                     sect.length_total = (((b_packet[sect.idx + 1] & 0x0F) << 8) + b_packet[sect.idx + 2]) # 12 uimsbf
                     if sect.length_total < 15:
+                        self.dropped += 1
                         next_packet = True
                         sect = None
                     elif sect.length_total <= section_length:
-                        sect.data.extend(b_packet[sect.idx:sect.idx + 3 + sect.length_total])
+                        sect.data.frombytes(b_packet[sect.idx:sect.idx + 3 + sect.length_total])
                         sect.idx += sect.length_total + 3
                         sect.length_current += sect.length_total
                         section_map[header.pid] = sect
                         next_packet = False
                     else:
-                        sect.data.extend(b_packet[sect.idx:])
+                        sect.data.frombytes(b_packet[sect.idx:])
                         sect.length_current += section_length
                         sect.idx = 5
                         section_map[header.pid] = sect
@@ -123,13 +549,13 @@ class TransportPacketParser:
                             next_packet = False
                     sect = None
                 elif remain <= section_length:
-                    sect.data.extend(b_packet[sect.idx:sect.idx + 3 + remain])
+                    sect.data.frombytes(b_packet[sect.idx:sect.idx + 3 + remain])
                     sect.idx += remain
                     sect.length_current += remain
                     section_map[header.pid] = sect
                     next_packet = False
                 else:
-                    sect.data.extend(b_packet[sect.idx:])
+                    sect.data.frombytes(b_packet[sect.idx:])
                     sect.length_current += section_length
                     sect.length_prev = 0
                     sect.idx = 5
@@ -139,7 +565,7 @@ class TransportPacketParser:
         else:
             # payload_unit_start_indicater set to 0b indicates that there is no pointer_field
             if sect.length_total != 0:
-                sect.data.extend(b_packet[4:])
+                sect.data.frombytes(b_packet[4:])
                 sect.length_current += 184
                 if sect.length_current >= sect.length_total:
                     section_map[header.pid] = Section()
@@ -184,13 +610,10 @@ def parseShortEventDescriptor(idx, event, t_packet, b_packet):
             chr(b_packet[idx + 3]) +
             chr(b_packet[idx + 4]))       # 24 bslbf
     event_name_length = b_packet[idx + 5] # 8 uimsbf
-    arib = AribString(b_packet[idx + 6:idx + 6 + event_name_length])
-    (event_name,symbol) = arib.convert_utf_split()
+    event_name = bytes(b_packet[idx + 6:idx + 6 + event_name_length])
     idx = idx + 6 + event_name_length
     text_length = b_packet[idx]           # 8 uimsbf
-    arib = AribString(b_packet[idx + 1:idx + 1 + text_length])
-    text = arib.convert_utf()
-    text = symbol + "\n" + text
+    text = bytes(b_packet[idx + 1:idx + 1 + text_length])
     desc = ShortEventDescriptor(descriptor_tag, descriptor_length,
             ISO_639_language_code, event_name_length, event_name,
             text_length, text)
@@ -219,8 +642,7 @@ def parseExtendedEventDescriptor(idx, event, t_packet, b_packet):
             item_length, item))
         idx = idx + 1 + item_length
     text_length = b_packet[idx] # 8 uimsbf
-    arib = AribString(b_packet[idx + 1:idx + 1 + text_length])
-    text = arib.convert_utf()
+    text = bytes(b_packet[idx + 1:idx + 1 + text_length])
     desc = ExtendedEventDescriptor(descriptor_tag, descriptor_length,
             descriptor_number, last_descriptor_number, ISO_639_language_code,
             length_of_items, item_list, text_length, text)
@@ -255,12 +677,10 @@ def parseServiceDescriptor(idx, service, t_packet, b_packet):
     descriptor_length = b_packet[idx + 1] # 8 uimsbf
     service_type = b_packet[idx + 2]      # 8 uimsbf
     service_provider_name_length = b_packet[idx + 3] # 8 uimsbf
-    arib = AribString(b_packet[idx + 4:idx + 4 + service_provider_name_length])
-    service_provider_name = arib.convert_utf()
+    service_provider_name = arib_utf(b_packet[idx + 4:idx + 4 + service_provider_name_length])
     idx = idx + 4 + service_provider_name_length
     service_name_length = b_packet[idx]   # 8 uimsbf
-    arib = AribString(b_packet[idx + 1:idx + 1 + service_name_length])
-    service_name = arib.convert_utf()
+    service_name = arib_utf(b_packet[idx + 1:idx + 1 + service_name_length])
     sd = ServiceDescriptor(descriptor_tag, descriptor_length, service_type,
             service_provider_name_length, service_provider_name,
             service_name_length, service_name)
@@ -280,7 +700,7 @@ def parseDescriptors(idx, table, t_packet, b_packet):
             iface[descriptor_tag](idx, table, t_packet, b_packet)
         idx = idx + 2 + descriptor_length
 
-def parseEvents(t_packet, b_packet):
+def parseEvents(t_packet, b_packet, descriptors=True):
     idx = 19
     length = t_packet.eit.section_length - idx
     while idx < length:
@@ -292,7 +712,8 @@ def parseEvents(t_packet, b_packet):
         descriptors_loop_length = ((b_packet[idx + 10] & 0x0F) << 8) + b_packet[idx + 11] # 12  uimsbf
         event = Event(t_packet.eit.transport_stream_id, t_packet.eit.service_id, event_id,
                 start_time, duration, running_status, free_CA_mode, descriptors_loop_length)
-        parseDescriptors(idx + 12, event, t_packet, b_packet)
+        if descriptors:
+            parseDescriptors(idx + 12, event, t_packet, b_packet)
         t_packet.eit.events.append(event)
         idx = idx + 12 + descriptors_loop_length
 
@@ -340,12 +761,15 @@ def add_event(b_type, event_map, t_packet):
                 else:
                     master.desc_extend.extend(desc.items)
 
-def fix_events(events):
+def fix_events(events, partial=False):
+    # events without a short event descriptor are dropped unless partial is set
     event_list = []
     for event in events:
         item_list = []
         item_map = {}
-        if event.desc_short == None:
+        if event.desc_short != None:
+            event.desc_short.decode()
+        elif not partial:
             continue
         if event.desc_extend != None:
             for item in event.desc_extend:
@@ -355,10 +779,8 @@ def fix_events(events):
                 else:
                     item_list.append(item)
             for item in item_list:
-                arib = AribString(item.item_description)
-                item.item_description = arib.convert_utf()
-                arib = AribString(item.item)
-                item.item = arib.convert_utf()
+                item.item_description = arib_utf(item.item_description)
+                item.item = arib_utf(item.item)
             for item in item_list:
                 item_map[item.item_description] = item.item
             event.desc_extend = item_map
@@ -375,42 +797,238 @@ def compare_service(x, y):
     else:
         return service_id
 
-def parse_eit(b_type, service, tsfile, debug):
-    # Event Information Table
-    ids = service.keys()
-    event_map = {}
-    parser = TransportPacketParser(tsfile, EIT_PID, debug)
-    for t_packet in parser:
-        if t_packet.eit.service_id in ids:
-            parseEvents(t_packet, t_packet.binary_data)
-            add_event(b_type, event_map, t_packet)
-    print("EIT: %i packets read" % (parser.count), file=sys.stderr)
+def add_service(service_map, t_packet):
+    if not t_packet.sdt.services:
+        parseService(t_packet, t_packet.binary_data)
+    for service in t_packet.sdt.services:
+        if (service.EIT_schedule_flag == 1 and
+                service.EIT_present_following_flag == 1 and
+                service.descriptors[0].service_type == 0x01):
+            service_map[service.service_id] = service.descriptors[0].service_name
+
+def sort_events(b_type, event_map):
     event_list = list(event_map.values())
     if b_type == TYPE_DIGITAL:
         event_list = sorted(event_list, key=cmp_to_key(compare_event))
     else:
         event_list = sorted(event_list, key=cmp_to_key(compare_service))
-    event_list = fix_events(event_list)
-    return event_list
+    return fix_events(event_list)
+
+class EpgCollector:
+    # Collects services and events from SDT/EIT sections in stream order
+    def __init__(self, b_type, debug=False, verify=CACHE_VERIFY_CRC):
+        self.b_type = b_type
+        self.debug = debug
+        self.service_map = {}
+        self.transport_stream_ids = {} # service_id -> transport_stream_id
+        self.event_map = {} # None when only tracking completion
+        self.pending = [] # EIT sections of services not (yet) found in SDT
+        self.sdt_done = False
+        self.sdt_tracker = ServiceTableTracker()
+        self.eit_tracker = EventTableTracker()
+        self.cache = SectionCache(verify)
+        self.unchanged = 0
+        self.finished = set() # services whose events have been handed out
+        self.section_events = None # section key -> (last_section_number, event ids), if a dict
+    def add(self, t_packet):
+        if t_packet.header.pid in SDT_PID:
+            if self.sdt_done:
+                return
+            add_service(self.service_map, t_packet)
+            for service in t_packet.sdt.services:
+                if service.service_id in self.service_map:
+                    self.transport_stream_ids.setdefault(service.service_id,
+                            t_packet.sdt.transport_stream_id)
+            self.sdt_tracker.add(t_packet.sdt, self.cache.key(t_packet.binary_data))
+            if self.b_type == TYPE_DIGITAL:
+                self.sdt_done = True
+            waiting = []
+            for p_packet in self.pending:
+                if p_packet.eit.service_id in self.service_map:
+                    self.add_events(p_packet)
+                else:
+                    waiting.append(p_packet)
+            self.pending = waiting
+        else:
+            if t_packet.eit.service_id in self.finished:
+                return
+            self.eit_tracker.add(t_packet.eit, self.cache.key(t_packet.binary_data),
+                    t_packet.header.pid)
+            if self.cache.unchanged(t_packet.binary_data):
+                # events of this section are already in the store
+                self.unchanged += 1
+            elif t_packet.eit.service_id in self.service_map:
+                self.add_events(t_packet)
+            else:
+                self.pending.append(t_packet)
+    def add_events(self, t_packet):
+        if not t_packet.eit.events:
+            parseEvents(t_packet, t_packet.binary_data)
+        if self.event_map != None:
+            add_event(self.b_type, self.event_map, t_packet)
+        if self.section_events != None:
+            self.section_events[self.cache.key(t_packet.binary_data)] = (
+                    t_packet.eit.last_section_number,
+                    [event.event_id for event in t_packet.eit.events])
+    def is_complete(self):
+        if not self.sdt_done and self.sdt_tracker.is_complete(self.cache):
+            self.sdt_done = True
+        if self.debug or not self.sdt_done:
+            return False
+        return self.eit_tracker.is_complete(self.service_map.keys(), self.cache)
+    def finish_service(self, service_id):
+        # events of a service whose schedule is complete, later sections of it are ignored
+        # GR shares event ids between services and debug reads the whole file,
+        # so their events are only handed out by events()
+        if (self.debug or self.b_type == TYPE_DIGITAL or service_id in self.finished or
+                service_id not in self.service_map or
+                not self.eit_tracker.is_service_complete(service_id, self.cache)):
+            return []
+        self.finished.add(service_id)
+        event_map = {}
+        for (m_id, event) in list(self.event_map.items()):
+            if event.service_id == service_id:
+                event_map[m_id] = self.event_map.pop(m_id)
+        return sort_events(self.b_type, event_map)
+    def events(self):
+        return sort_events(self.b_type, self.event_map)
+
+def iter_events(t_packets):
+    # events of every EIT section as parsed, before merging and decoding
+    for t_packet in t_packets:
+        if t_packet.header.pid not in EIT_PID:
+            continue
+        if not t_packet.eit.events:
+            parseEvents(t_packet, t_packet.binary_data)
+        yield from t_packet.eit.events
+
+def scan_tables(collector, parser, t_packets=None):
+    # SDT/EIT transport packets fed to the collector until its schedule is complete,
+    # read from the parser unless the caller runs the stages itself
+    if t_packets == None:
+        t_packets = parser
+    for t_packet in t_packets:
+        collector.add(t_packet)
+        yield t_packet
+        if collector.is_complete():
+            parser.done = True
+            break
+        if collector.sdt_done and parser.pid != EIT_PID:
+            parser.set_pid(EIT_PID)
 
-def parse_sdt(b_type, tsfile, debug):
-    # Service Description Table
+def iter_epg(b_type, tsfile, debug=False, max_packets=None, timeout=None, collector=None,
+        verify=CACHE_VERIFY_CRC, stats=None):
+    # finalized events, service by service as each schedule completes and the rest at the end
+    if collector == None:
+        collector = EpgCollector(b_type, debug, verify)
+    start = time.perf_counter()
+    parser = TransportPacketParser(tsfile, SDT_PID + EIT_PID, debug,
+            collector.cache, collector.is_complete, max_packets, timeout)
+    for t_packet in scan_tables(collector, parser):
+        if t_packet.header.pid in EIT_PID:
+            yield from collector.finish_service(t_packet.eit.service_id)
+    # scan time includes decoding the services finished on the way
+    scanned = time.perf_counter()
+    events = collector.events()
+    report_scan(tsfile, parser, collector, stats, start, scanned, time.perf_counter())
+    yield from events
+
+def parse_ts(b_type, tsfile, debug, max_packets=None, timeout=None, collector=None, stats=None,
+        verify=CACHE_VERIFY_CRC):
+    # Service Description Table and Event Information Table in one pass
+    if collector == None:
+        collector = EpgCollector(b_type, debug, verify)
+    start = time.perf_counter()
+    parser = TransportPacketParser(tsfile, SDT_PID + EIT_PID, debug,
+            collector.cache, collector.is_complete, max_packets, timeout)
+    for t_packet in scan_tables(collector, parser):
+        pass
+    scanned = time.perf_counter()
+    # sorting and decoding the text of the surviving events
+    events = collector.events()
+    report_scan(tsfile, parser, collector, stats, start, scanned, time.perf_counter())
+    return (collector.service_map, events)
+
+def report_scan(tsfile, parser, collector, stats, start, scanned, finished):
+    print("SDT/EIT: %i packets read, %i duplicate sections skipped" % (
+            parser.count, collector.cache.count), file=sys.stderr)
+    if parser.crc_errors:
+        print("CRC: %i sections failed, %i messages suppressed" % (parser.crc_errors,
+                max(parser.crc_errors - CRC_ERROR_MESSAGES_MAX, 0)), file=sys.stderr)
+    info = ARIB_CACHE.info()
+    print("ARIB: %i strings decoded, %i cache hits" % (
+            info['utf']['misses'] + info['utf_split']['misses'],
+            info['utf']['hits'] + info['utf_split']['hits']), file=sys.stderr)
+    if stats != None:
+        stats.update({
+                'bytes_read':tsfile.bytes_read,
+                'packets':parser.count,
+                'sync_losses':tsfile.sync_losses,
+                'packets_per_pid':dict(('0x%04X' % pid, count)
+                    for (pid, count) in sorted(parser.pid_count.items())),
+                'sections_reassembled':parser.section_count,
+                'sections_dropped':parser.dropped,
+                'crc_errors':parser.crc_errors,
+                'duplicate_sections':collector.cache.count,
+                'unchanged_sections':collector.unchanged,
+                'arib_strings_decoded':info['utf']['misses'] + info['utf_split']['misses'],
+                'arib_cache_hits':info['utf']['hits'] + info['utf_split']['hits'],
+                'scan_seconds':round(scanned - start, 6),
+                'decode_seconds':round(finished - scanned, 6)})
+
+def find_events(tsfile, event_ids, debug=False, max_packets=None, timeout=None, stats=None,
+        verify=CACHE_VERIFY_CRC):
+    # (start_time, duration) of each (transport_stream_id, service_id, event_id) found,
+    # from the event headers of EIT sections without their descriptors; reading stops
+    # once every id is found, or the schedule of its service is complete without it,
+    # or the complete SDT does not list its service
+    found = {}
+    missing = set(event_ids)
     service_map = {}
-    parser = TransportPacketParser(tsfile, SDT_PID, debug)
+    sdt_tracker = ServiceTableTracker()
+    eit_tracker = EventTableTracker()
+    cache = SectionCache(verify)
+    sdt_done = False
+    def complete():
+        nonlocal sdt_done
+        if not sdt_done:
+            sdt_done = sdt_tracker.is_complete(cache)
+        if debug:
+            return False
+        for (transport_stream_id, service_id, event_id) in missing:
+            if service_id in service_map:
+                if not eit_tracker.is_service_complete(service_id, cache):
+                    return False
+            elif not sdt_done:
+                return False
+        return True
+    start = time.perf_counter()
+    parser = TransportPacketParser(tsfile, SDT_PID + EIT_PID, debug, cache, complete,
+            max_packets, timeout)
     for t_packet in parser:
-        parseService(t_packet, t_packet.binary_data)
-        for service in t_packet.sdt.services:
-            if (service.EIT_schedule_flag == 1 and
-                    service.EIT_present_following_flag == 1 and
-                    service.descriptors[0].service_type == 0x01):
-                service_map[service.service_id] = service.descriptors[0].service_name
-        if b_type == TYPE_DIGITAL:
+        if t_packet.header.pid in SDT_PID:
+            add_service(service_map, t_packet)
+            sdt_tracker.add(t_packet.sdt, cache.key(t_packet.binary_data))
+        else:
+            eit_tracker.add(t_packet.eit, cache.key(t_packet.binary_data), t_packet.header.pid)
+            parseEvents(t_packet, t_packet.binary_data, False)
+            for event in t_packet.eit.events:
+                key = (event.transport_stream_id, event.service_id, event.event_id)
+                if key in missing:
+                    found[key] = (event.start_time, event.duration)
+                    missing.discard(key)
+        if complete():
             break
-    print("SDT: %i packets read" % (parser.count), file=sys.stderr)
-    return service_map
-
-def parse_ts(b_type, tsfile, debug):
-    service = parse_sdt(b_type, tsfile, debug)
-    tsfile.seek(0)
-    events = parse_eit(b_type, service, tsfile, debug)
-    return (service, events)
+        if sdt_done and parser.pid != EIT_PID:
+            parser.set_pid(EIT_PID)
+    print("EIT: %i packets read, %i of %i events found" % (
+            parser.count, len(found), len(found) + len(missing)), file=sys.stderr)
+    if stats != None:
+        stats.update({
+                'bytes_read':tsfile.bytes_read,
+                'packets':parser.count,
+                'sections_reassembled':parser.section_count,
+                'crc_errors':parser.crc_errors,
+                'events_found':len(found),
+                'scan_seconds':round(time.perf_counter() - start, 6)})
+    return found
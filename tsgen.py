@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import random
+import struct
+import getopt
+import datetime
+
+from constant import *
+from aribtable import crc32mpeg_calc
+
+BACKGROUND_PID = 0x100
+
+KANJI = '番組内容出演者天気予報映画音楽東京大阪日本語放送時間特集情報'
+HIRAGANA = 'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん'
+KATAKANA = 'アイウエオカキクケコサシスセソ'
+ALNUM = 'abcXYZ0123'
+GAIJI = (0x7A56, 0x7A6A, 0x7A6B, 0x7C21, 0x7A60) # 【字】【新】【再】→ ■
+
+def encode_arib(chars):
+    # G3 <- additional symbols, GL = G0 kanji, GR = G2 hiragana
+    out = bytearray(b'\x1b\x24\x2b\x3b')
+    alnum = False
+    for ch in chars:
+        if isinstance(ch, int):
+            out += bytes((0x1D, ch >> 8, ch & 0xFF)) # SS3
+        elif ch == '\n':
+            out.append(0x0D)
+        elif ch == ' ':
+            out.append(0x20)
+        elif ord(ch) < 0x7F:
+            if not alnum:
+                out.append(0x0E) # LS1, G1 alnum
+                alnum = True
+            out.append(ord(ch))
+        else:
+            jis = ch.encode('iso-2022-jp')[3:5]
+            if jis[0] == 0x24 and jis[1] < 0x74:
+                out.append(jis[1] | 0x80)
+                continue
+            if alnum:
+                out.append(0x0F) # LS0
+                alnum = False
+            out += jis
+    return bytes(out)
+
+def make_words(rnd, count, gaiji):
+    chars = []
+    for _ in range(count):
+        r = rnd.random()
+        if r < 0.3:
+            chars.append(rnd.choice(KANJI))
+        elif r < 0.6:
+            chars.append(rnd.choice(HIRAGANA))
+        elif r < 0.7:
+            chars.append(rnd.choice(KATAKANA))
+        elif r < 0.8:
+            chars.append(rnd.choice(ALNUM))
+        elif r < 0.85:
+            chars.append(' ')
+        elif r < 0.87:
+            chars.append('\n')
+        elif gaiji and r < 0.92:
+            chars.append(rnd.choice(GAIJI))
+        else:
+            chars.append(rnd.choice(KANJI))
+    return chars
+
+def make_section(table_id, table_id_extension, version_number, section_number,
+        last_section_number, header, body):
+    section_length = 5 + len(header) + len(body) + 4
+    data = bytes((table_id, 0xF0 | (section_length >> 8), section_length & 0xFF,
+        table_id_extension >> 8, table_id_extension & 0xFF,
+        0xC1 | (version_number << 1), section_number, last_section_number)) + header + body
+    return data + struct.pack('>I', crc32mpeg_calc(data))
+
+def bcd(value):
+    return ((value // 10) << 4) | (value % 10)
+
+def mjd(year, month, day):
+    l = 1 if month <= 2 else 0
+    return 14956 + day + int((year - 1900 - l) * 365.25) + int((month + 1 + l * 12) * 30.6001)
+
+def make_event(rnd, event_id, start, duration, desc_length, gaiji, extended,
+        extended_tables=False):
+    # start and duration in minutes from 2024-05-01 00:00; with extended_tables
+    # the extended event descriptor is returned as a second event of its own
+    day = datetime.date(2024, 5, 1) + datetime.timedelta(days=start // 1440)
+    start_time = struct.pack('>H', mjd(day.year, day.month, day.day)) + bytes((
+        bcd((start % 1440) // 60), bcd(start % 60), 0))
+    duration = bytes((bcd(duration // 60), bcd(duration % 60), 0))
+    name = encode_arib(make_words(rnd, 12, gaiji))[:90]
+    text = encode_arib(make_words(rnd, desc_length, gaiji))[:150]
+    sed = b'jpn' + bytes((len(name),)) + name + bytes((len(text),)) + text
+    descriptors = bytes((TAG_SED, len(sed))) + sed
+    extended_descriptors = None
+    if extended:
+        items = b''
+        for label in ('番組内容', '出演者'):
+            description = encode_arib(label)
+            item = encode_arib(make_words(rnd, desc_length, gaiji))[:100]
+            items += bytes((len(description),)) + description + bytes((len(item),)) + item
+        eed = b'\x01jpn' + bytes((len(items),)) + items + b'\x00'
+        if extended_tables:
+            extended_descriptors = bytes((TAG_EED, len(eed))) + eed
+        else:
+            descriptors += bytes((TAG_EED, len(eed))) + eed
+    cd = bytes(((rnd.randrange(0, 8) << 4) | rnd.randrange(0, 4), 0xFF, 0xF0, 0xFF))
+    descriptors += bytes((TAG_CD, len(cd))) + cd
+    def event(descriptors):
+        return (struct.pack('>H', event_id) + start_time + duration +
+                bytes((0x80 | (len(descriptors) >> 8), len(descriptors) & 0xFF)) + descriptors)
+    if not extended_tables:
+        return event(descriptors)
+    return (event(descriptors), event(extended_descriptors) if extended else None)
+
+def schedule_sections(first_table_id, service_id, event_list, version_number, header):
+    # 4 events per section, 256 sections per table
+    sections = []
+    chunks = [event_list[i:i + 4] for i in range(0, len(event_list), 4)]
+    if len(chunks) > 8 * 256:
+        raise ValueError('too many events for one schedule')
+    last_table_id = first_table_id + (len(chunks) - 1) // 256
+    for (i, chunk) in enumerate(chunks):
+        (table_id, section_number) = (first_table_id + i // 256, i % 256)
+        last_section_number = min(len(chunks) - 1 - (i & ~0xFF), 0xFF)
+        segment_last_section_number = min(last_section_number, (section_number & 0xF8) + 7)
+        sections.append(make_section(table_id, service_id, version_number, section_number,
+            last_section_number, header + bytes((segment_last_section_number, last_table_id)),
+            b''.join(chunk)))
+    return sections
+
+def build_tables(rnd, b_type, services, events, desc_length, gaiji, extended,
+        version_number, extended_tables=False, transport_stream_id=0x4010,
+        original_network_id=4):
+    # one SDT section, p/f and basic schedule (4 events per section) per service;
+    # with extended_tables the extended descriptors follow in extended schedule
+    # tables after the basic ones of every service
+    if b_type == TYPE_DIGITAL:
+        service_ids = [1024 + i for i in range(services)]
+    else:
+        service_ids = [101 + i * 10 for i in range(services)]
+    body = b''
+    for service_id in service_ids:
+        provider = encode_arib('放送局')
+        name = encode_arib('テスト%d' % service_id)
+        sd = bytes((0x01, len(provider))) + provider + bytes((len(name),)) + name
+        descriptors = bytes((TAG_SD, len(sd))) + sd
+        body += struct.pack('>H', service_id) + bytes((0xE3,
+            0x80 | (len(descriptors) >> 8), len(descriptors) & 0xFF)) + descriptors
+    sdt = [make_section(SDT_TABLE_ID[0], transport_stream_id, version_number, 0, 0,
+        struct.pack('>H', original_network_id) + b'\xff', body)]
+    eit = []
+    extended_eit = []
+    header = struct.pack('>HH', transport_stream_id, original_network_id)
+    for service_id in service_ids:
+        event_list = [make_event(rnd, 0x100 + i, i * 30, 30, desc_length, gaiji, extended,
+                extended_tables) for i in range(events)]
+        if extended_tables:
+            extended_list = [event[1] for event in event_list if event[1] != None]
+            event_list = [event[0] for event in event_list]
+            if extended_list:
+                extended_eit += schedule_sections(0x58, service_id, extended_list,
+                        version_number, header)
+        for section_number in range(min(2, events)):
+            eit.append(make_section(EIT_PF_TABLE_ID[0], service_id, version_number,
+                section_number, 1, header + bytes((1, EIT_PF_TABLE_ID[0])),
+                event_list[section_number]))
+        eit += schedule_sections(0x50, service_id, event_list, version_number, header)
+    return (sdt, eit + extended_eit)
+
+def packetize(pid, sections, counter, packed):
+    # one section per packet run, or sections packed back to back with pointer_field
+    packets = []
+    def packet(payload_unit_start, payload):
+        packets.append(bytes((0x47, (0x40 if payload_unit_start else 0) | (pid >> 8),
+            pid & 0xFF, 0x10 | (counter[pid] & 0x0F))) +
+            payload + b'\xff' * (184 - len(payload)))
+        counter[pid] += 1
+    if not packed:
+        for section in sections:
+            payload = b'\x00' + section
+            for pos in range(0, len(payload), 184):
+                packet(pos == 0, payload[pos:pos + 184])
+        return packets
+    data = b''.join(sections)
+    starts = []
+    pos = 0
+    for section in sections:
+        starts.append(pos)
+        pos += len(section)
+    pos = 0
+    while pos < len(data):
+        first = [start for start in starts if pos <= start < pos + 183]
+        if first:
+            packet(True, bytes((first[0] - pos,)) + data[pos:pos + 183])
+            pos += 183
+        else:
+            packet(False, data[pos:pos + 184])
+            pos += 184
+    return packets
+
+def generate(filename, seed=1, b_type=TYPE_DIGITAL, services=3, events=16,
+        repeats=3, desc_length=40, gaiji=True, extended=True, background=0.8,
+        corrupt=0.0, packed=False, version_number=1, extended_tables=False, sdt_repeats=1):
+    # background: share of packets that are not SDT/EIT
+    # sdt_repeats: times the SDT is sent while the EIT goes around once
+    # corrupt: bytes flipped per packet written
+    if not 0 <= background < 1:
+        raise ValueError('background must be at least 0 and less than 1')
+    rnd = random.Random(seed)
+    (sdt, eit) = build_tables(rnd, b_type, services, events, desc_length,
+            gaiji, extended, version_number, extended_tables)
+    counter = {SDT_PID[0]:0, EIT_PID[0]:0, BACKGROUND_PID:0}
+    packets = []
+    for _ in range(repeats):
+        sdt_packets = packetize(SDT_PID[0], sdt * sdt_repeats, counter, packed)
+        for eit_packet in packetize(EIT_PID[0], eit, counter, packed):
+            packets.append(eit_packet)
+            if sdt_packets and rnd.random() < 0.3:
+                packets.append(sdt_packets.pop(0))
+            while rnd.random() < background:
+                packets.append(bytes((0x47, BACKGROUND_PID >> 8, BACKGROUND_PID & 0xFF,
+                    0x10 | (counter[BACKGROUND_PID] & 0x0F))) + rnd.randbytes(184))
+                counter[BACKGROUND_PID] += 1
+        packets.extend(sdt_packets)
+    data = bytearray(b''.join(packets))
+    for _ in range(int(len(packets) * corrupt)):
+        data[rnd.randrange(len(data))] ^= 0xFF
+    f = open(filename, 'wb')
+    f.write(data)
+    f.close()
+    return len(packets)
+
+def usage():
+    print('''USAGE: tsgen.py [OPTIONS] -o OUTPUT_FILE
+  -h, --help          print help message
+  -b, --bs            generate BS services
+  -s, --cs            generate CS services
+  -o, --output        specify ts file
+  -r, --seed          random seed (default 1)
+  -n, --services      number of services (default 3)
+  -e, --events        events per service (default 16)
+  -c, --carousel      number of times the tables are repeated (default 3)
+  -l, --desc-length   characters per description (default 40)
+  -g, --no-gaiji      do not use additional symbols
+  -x, --no-extended   do not add extended event descriptors
+  -X, --extended-tables
+                      send extended event descriptors in extended schedule
+                      tables after the basic ones
+  -B, --background    share of background packets, 0 <= B < 1 (default 0.8)
+  -C, --corrupt       bytes flipped per packet (default 0)
+  -p, --packed        pack sections back to back
+  -v, --version       version_number of the tables (default 1)
+  -S, --sdt-repeats   times the SDT is sent per EIT carousel (default 1)
+''', file=sys.stderr)
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hbso:r:n:e:c:l:gxXB:C:pv:S:', ['help',
+            'bs', 'cs', 'output=', 'seed=', 'services=', 'events=', 'carousel=',
+            'desc-length=', 'no-gaiji', 'no-extended', 'extended-tables', 'background=',
+            'corrupt=', 'packed', 'version=', 'sdt-repeats='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    output_file = None
+    kw = {}
+    for o,a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o in ('-b', '--bs'):
+            kw['b_type'] = TYPE_BS
+        elif o in ('-s', '--cs'):
+            kw['b_type'] = TYPE_CS
+        elif o in ('-o', '--output'):
+            output_file = a
+        elif o in ('-r', '--seed'):
+            kw['seed'] = int(a)
+        elif o in ('-n', '--services'):
+            kw['services'] = int(a)
+        elif o in ('-e', '--events'):
+            kw['events'] = int(a)
+        elif o in ('-c', '--carousel'):
+            kw['repeats'] = int(a)
+        elif o in ('-l', '--desc-length'):
+            kw['desc_length'] = int(a)
+        elif o in ('-g', '--no-gaiji'):
+            kw['gaiji'] = False
+        elif o in ('-x', '--no-extended'):
+            kw['extended'] = False
+        elif o in ('-X', '--extended-tables'):
+            kw['extended_tables'] = True
+        elif o in ('-B', '--background'):
+            kw['background'] = float(a)
+        elif o in ('-C', '--corrupt'):
+            kw['corrupt'] = float(a)
+        elif o in ('-p', '--packed'):
+            kw['packed'] = True
+        elif o in ('-v', '--version'):
+            kw['version_number'] = int(a)
+        elif o in ('-S', '--sdt-repeats'):
+            kw['sdt_repeats'] = int(a)
+    if output_file == None:
+        usage()
+        sys.exit(1)
+    count = generate(output_file, **kw)
+    print("%s: %i packets" % (output_file, count), file=sys.stderr)
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import xml.etree.ElementTree as ET
-import xml.dom.minidom as MD
 
 from constant import *
 
@@ -15,30 +14,63 @@ def get_text(text):
     else:
         return ""
 
+class XmltvWriter:
+    # Writes the tv document element by element instead of building it in memory
+    def __init__(self, fd, pretty_print):
+        self.fd = fd
+        self.pretty_print = pretty_print
+    def start(self):
+        attr = {
+                'generator-info-name':'epgdump_py',
+                'generator-info-url':'mailto:epgdump_py@gmail.com'}
+        tv_el = ET.Element('tv', attr)
+        tv_str = ET.tostring(tv_el, encoding='unicode', short_empty_elements=False)
+        if self.pretty_print:
+            self.fd.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+            self.fd.write(tv_str[:-len('</tv>')].encode('utf-8') + b'\n')
+        else:
+            self.fd.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+            self.fd.write(tv_str[:-len('</tv>')].encode('utf-8'))
+    def write(self, el):
+        if self.pretty_print:
+            ET.indent(el, '  ', 1)
+            # empty elements as minidom wrote them; '>' in text and attributes is escaped
+            xml_str = ET.tostring(el, encoding='utf-8', xml_declaration=False)
+            self.fd.write(b'  ' + xml_str.replace(b' />', b'/>') + b'\n')
+        else:
+            self.fd.write(ET.tostring(el, encoding='utf-8', xml_declaration=False))
+    def end(self):
+        if self.pretty_print:
+            self.fd.write(b'</tv>\n')
+        else:
+            self.fd.write(b'</tv>')
+
 def create_xml(b_type, channel_id, service, events, filename, pretty_print, output_eid):
-    channel_el_list = create_channel(b_type, channel_id, service)
-    programme_el_list = create_programme(channel_id, events, b_type, output_eid)
-    attr = {
-            'generator-info-name':'epgdump_py',
-            'generator-info-url':'mailto:epgdump_py@gmail.com'}
-    tv_el = ET.Element('tv', attr)
-
-    for el in channel_el_list:
-        tv_el.append(el)
-    for el in programme_el_list:
-        tv_el.append(el)
+    fd = open(filename, 'wb')
+    writer = XmltvWriter(fd, pretty_print)
+    writer.start()
+    for el in create_channel(b_type, channel_id, service):
+        writer.write(el)
+    for el in create_programme(channel_id, events, b_type, output_eid):
+        writer.write(el)
+    writer.end()
+    fd.close()
 
+def create_merged_xml(results, filename, pretty_print, output_eid):
+    # results: list of (b_type, channel_id, service, events)
     fd = open(filename, 'wb')
-    if pretty_print:
-        xml_str = ET.tostring(tv_el)
-        xml_str = MD.parseString(xml_str).toprettyxml(indent='  ', encoding='utf-8')
-        fd.write(xml_str)
-    else:
-        ET.ElementTree(tv_el).write(fd, 'utf-8', ' ')
+    writer = XmltvWriter(fd, pretty_print)
+    writer.start()
+    for (b_type, channel_id, service, events) in results:
+        for el in create_channel(b_type, channel_id, service):
+            writer.write(el)
+    for (b_type, channel_id, service, events) in results:
+        for el in create_programme(channel_id, events, b_type, output_eid):
+            writer.write(el)
+    writer.end()
     fd.close()
 
 def create_channel(b_type, channel_id, service):
-    el_list = []
     for (service_id, service_name) in service.items():
         ch = b_type + str(service_id) if channel_id == None else channel_id
         attr = {'id':ch}
@@ -57,13 +89,10 @@ def create_channel(b_type, channel_id, service):
         display_el.text = ch + ' ' + get_text(service_name)
         channel_el.append(display_el)
 
-        el_list.append(channel_el)
-
-    return el_list
+        yield channel_el
 
 def create_programme(channel_id, events, b_type, output_eid):
     t_format = '%Y%m%d%H%M%S +0900'
-    el_list = []
     for event in events:
         ch = b_type + str(event.service_id) if channel_id == None else channel_id
         start = event.start_time.strftime(t_format)
@@ -110,6 +139,4 @@ def create_programme(channel_id, events, b_type, output_eid):
             el.text = str(event.event_id)
             programme_el.append(el)
 
-        el_list.append(programme_el)
-
-    return el_list
+        yield programme_el